@@ -0,0 +1,232 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Asyncio variant of the lizard api clients.
+
+The Async* classes mirror the clients in freq.lizard_connector, but get,
+fetch and parse are awaitable, so independent requests can run at the same
+time::
+
+    locations = AsyncGroundwaterLocations()
+    timeseries = AsyncGroundwaterTimeSeries()
+    run(locations.bbox(south_west, north_east),
+        timeseries.bbox(south_west, north_east, statistic='mean'))
+
+Requests go over the shared keep-alive transport in the default executor of
+the event loop.
+"""
+import asyncio
+import logging
+
+from freq.lizard_connector import Base
+from freq.lizard_connector import GroundwaterLocations
+from freq.lizard_connector import GroundwaterTimeSeries
+from freq.lizard_connector import LizardApiError
+from freq.lizard_connector import Locations
+from freq.lizard_connector import TimeSeries
+
+
+logger = logging.getLogger(__name__)
+
+
+def run(*coroutines):
+    """
+    Runs coroutines concurrently in a new event loop, for use in synchronous
+    code such as views.
+    :return: list with the results of the coroutines in their order. When a
+             coroutine raises, the others are cancelled and the error is
+             raised.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        tasks = [asyncio.ensure_future(coroutine, loop=loop)
+                 for coroutine in coroutines]
+        try:
+            return loop.run_until_complete(asyncio.gather(*tasks))
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            raise
+    finally:
+        loop.close()
+
+
+class AsyncBase(Base):
+    """
+    Base class to connect to the different endpoints of the lizard-api with
+    asyncio. See freq.lizard_connector.Base for the parameters.
+    """
+
+    def get(self, count=True, uuid=None, **queries):
+        """
+        Query the api.
+        The url is built when get is called, the request is made when the
+        result is awaited.
+        :param queries: all keyword arguments are used as queries.
+        :return: an awaitable of the results.
+        """
+        return self.get_url(self.query_url(uuid, **queries))
+
+    async def get_url(self, url):
+        """
+        Query the api with a full url.
+        Stores the api-response as a dict in the results attribute.
+        :return: the results.
+        """
+        loop = asyncio.get_running_loop()
+        self.json, events = await loop.run_in_executor(
+            None, self.request_query, url)
+        self.events += events
+        await self.parse()
+        return self.results
+
+    async def fetch(self, url):
+        """
+        GETs parameters from the api based on an url in a JSON format.
+        Stores the JSON response in the json attribute.
+        :param url: full query url
+        :return: the JSON from the response
+        """
+        loop = asyncio.get_running_loop()
+        if self.events_field:
+            self.json, events = await loop.run_in_executor(
+                None, self.request_events, url)
+            self.events += events
+        else:
+            self.json = await loop.run_in_executor(
+                None, self.request_json, url)
+        return self.json
+
+    async def parse(self):
+        """
+        Parse the json attribute and store it to the results attribute.
+        All pages of a query are parsed. If the max_results attribute is
+        exceeded an ApiError is raised.
+        """
+        while True:
+            try:
+                if self.json['count'] > self.max_results:
+                    raise LizardApiError(
+                        'Too many results: {} found, while max {} are '
+                        'accepted'.format(self.json['count'], self.max_results)
+                    )
+                self.results += self.json['results']
+                next_url = self.json.get('next')
+                if not next_url:
+                    break
+                page_urls = None if self.events_field else \
+                    self.page_urls(next_url)
+                if page_urls:
+                    for page in await self.fetch_pages(page_urls):
+                        self.results += page['results']
+                    break
+                await self.fetch(next_url)
+            except KeyError:
+                self.results += [self.json]
+                break
+            except IndexError:
+                break
+
+    async def fetch_pages(self, urls):
+        """
+        GETs the JSON of multiple urls concurrently, with at most
+        max_concurrent_pages requests in flight.
+        :return: list of the JSON responses in the order of urls.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrent_pages))
+
+        async def fetch_page(url):
+            async with semaphore:
+                return await loop.run_in_executor(None, self.request_json,
+                                                  url)
+
+        return await asyncio.gather(*(fetch_page(url) for url in urls))
+
+    async def parse_elements(self, element):
+        """
+        Get a list of a certain element from the root of the results attribute.
+        :param element: the element you wish to get.
+        :return: A list of all elements in the root of the results attribute.
+        """
+        await self.parse()
+        return [x[element] for x in self.results]
+
+
+class AsyncLocations(AsyncBase, Locations):
+    """
+    Makes a connection to the locations endpoint of the lizard api.
+    """
+
+
+class AsyncTimeSeries(AsyncBase, TimeSeries):
+    """
+    Makes a connection to the timeseries endpoint of the lizard api.
+    """
+
+    async def location_uuid(self, loc_uuid, start='0001-01-01T00:00:00Z',
+                            end=None, organisation=None, metadata_only=False):
+        """
+        Returns time series for a location by location-UUID. The timeseries
+        of the location are downloaded concurrently, with at most
+        max_concurrent_timeseries downloads at the same time.
+        :param loc_uuid: name of a location
+        :param start: start timestamp in ISO 8601 format
+        :param end: end timestamp in ISO 8601 format, defaults to now
+        :param metadata_only: when True only the metadata of the timeseries
+                              is returned and their events are not
+                              downloaded.
+        :return: a dictionary of with nested location, aquo quantities and
+                 events.
+        """
+        org_query = self.organisation_query(organisation)
+        await self.get(location__uuid=loc_uuid, **org_query)
+        if metadata_only:
+            return self.results
+        timeseries = [(type(self)(self.base, use_header=self.use_header),
+                       x['uuid']) for x in self.results]
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrent_timeseries))
+
+        async def download(ts, ts_uuid):
+            async with semaphore:
+                return await ts.uuid(ts_uuid, start, end, organisation)
+
+        await asyncio.gather(*(download(ts, ts_uuid)
+                               for ts, ts_uuid in timeseries))
+        self.results = [result for ts, _ in timeseries
+                        for result in ts.results]
+        return self.results
+
+    async def bbox(self, south_west, north_east, statistic=None,
+                   start='0001-01-01T00:00:00Z', end=None, organisation=None):
+        """
+        Find all timeseries within a certain bounding box, see
+        TimeSeries.bbox. The first and last year of the difference (mean
+        last - first year) are requested concurrently.
+        """
+        queries = self.bbox_queries(south_west, north_east, statistic, start,
+                                    end, organisation)
+        if len(queries) == 1:
+            return await self.get(**queries[0])
+        first_year = type(self)(self.base, use_header=self.use_header)
+        first_year.queries = self.queries
+        await asyncio.gather(first_year.get(**queries[0]),
+                             self.get(**queries[1]))
+        self.combine_years(first_year.results)
+        return self.results
+
+
+class AsyncGroundwaterLocations(AsyncLocations, GroundwaterLocations):
+    """
+    Makes a connection to the locations endpoint of the lizard api.
+    Only selects GroundwaterStations.
+    """
+
+
+class AsyncGroundwaterTimeSeries(AsyncTimeSeries, GroundwaterTimeSeries):
+    """
+    Makes a connection to the timeseries endpoint of the lizard api.
+    Only selects GroundwaterStations.
+    """
@@ -0,0 +1,385 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the numerical parts of freq.
+
+Every benchmark compares the current implementation with the straightforward
+implementation it replaced. Run them with::
+
+    python -m freq.benchmark [name ...]
+
+Without names all benchmarks are run.
+"""
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from freq import freq_calculator as calculator
+from freq import jsdatetime
+from freq import lizard_connector
+from freq import parallel
+
+
+def best_of(func, repeat=3):
+    """
+    :return: the fastest wall clock time in seconds of repeat runs of func.
+    """
+    return min(timeit.repeat(func, repeat=repeat, number=1))
+
+
+def sample_series(size, seed=0):
+    """
+    A groundwater-like series: seasonal cycle, slow trend and noise.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(size)
+    return (3 * np.sin(2 * np.pi * t / 365.25) + 0.001 * t +
+            rng.randn(size))
+
+
+def sample_results(size, seed=0):
+    """
+    Timeseries bbox results with the statistics of size locations, some of
+    them without events or timestamps.
+    """
+    rng = np.random.RandomState(seed)
+    results = []
+    for i in range(size):
+        first = int(rng.randint(0, 10**12))
+        result = {
+            'uuid': 'ts-{0}'.format(i),
+            'location': {'uuid': 'loc-{0}'.format(i)},
+            'first_value_timestamp': first if i % 50 else None,
+            'last_value_timestamp': first + int(rng.randint(0, 10**11)),
+            'events': [] if i % 97 == 0 else [{
+                'min': rng.randn(), 'max': rng.randn() + 3,
+                'sum': rng.randn() * 100, 'count': int(rng.randint(1, 500))
+            }]
+        }
+        results.append(result)
+    return results
+
+
+def django_settings():
+    """
+    Minimal settings for benchmarks of the rest framework parts, when no
+    settings module is given.
+    """
+    from django.conf import settings
+    if not settings.configured and \
+            not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        settings.configure()
+
+
+def trend_payload(size, chart_values):
+    """
+    Response of a trend view with three chart series of size points.
+    """
+    index = pd.date_range('1900-01-01', periods=size, freq='D')
+    series = [sample_series(size, seed) for seed in range(3)]
+    return {'graphs': [{
+        'name': '#chart_0 svg',
+        'data': [{'values': chart_values(data, index), 'key': str(i),
+                  'color': '#2980b9'} for i, data in enumerate(series)],
+        'measurement_point': 'Groundwater well: benchmark'
+    }], 'statistics': []}
+
+
+# ---------------------------------------------------------------------------- #
+### Reference implementations
+
+
+def _harmonic_reference(data, n_harmonics):
+    data = data - np.mean(data)
+    fft_vec = np.fft.fft(data)
+    ps = np.abs(fft_vec)**2
+    ps_lim = np.sort(ps)[-n_harmonics*2]
+    clean_fft_vec = np.array([fft_vec[i] if ps[i] >= ps_lim else 0
+                              for i in range(len(fft_vec))])
+    trend = np.real(np.fft.ifft(clean_fft_vec))
+    a_param = np.array([np.real(fft_vec[i]) for i in range(len(fft_vec))
+                        if ps[i] <= ps_lim])
+    b_param = np.array([np.imag(fft_vec[i]) for i in range(len(fft_vec))
+                        if ps[i] <= ps_lim])
+    sigma_param = np.array([np.abs(fft_vec[i])**2 for i in range(len(fft_vec))
+                            if ps[i] <= ps_lim])
+    ps = ps[:int(len(ps)/2)]
+    ps = np.sort(ps)[::-1]
+    ac_ps = np.cumsum(ps/np.max(np.cumsum(ps)))
+    det_serie = np.array(data - trend)
+    x_ac_ps = len(ac_ps)/np.array(range(1, len(ac_ps) + 1))
+    return det_serie, trend, (a_param, b_param, sigma_param), ac_ps, x_ac_ps
+
+
+def _correlogram_reference(data, n_lags):
+    z = np.zeros((len(data)-n_lags+1, n_lags))
+    for i in range(n_lags):
+        z[:,i] = data[i:len(data) - n_lags + 1 + i]
+    return np.corrcoef(z, rowvar=0)[0, :]
+
+
+def _autoregressive_reference(data, max_order):
+    from statsmodels.tsa.ar_model import AutoReg
+    fits = [AutoReg(data, order).fit() for order in range(max_order + 1)]
+    return ([fit.params for fit in fits], [fit.sigma2 for fit in fits],
+            [fit.aic for fit in fits])
+
+
+def _mann_kendall_reference(data):
+    s = 0
+    slopes = []
+    for i in range(len(data) - 1):
+        differences = data[i + 1:] - data[i]
+        s += np.sign(differences).sum()
+        slopes.append(differences / np.arange(1, len(data) - i))
+    return s, np.median(np.concatenate(slopes))
+
+
+def sample_observations(size, seed=0):
+    """
+    Irregular raw observations of sample_series, about one an hour, as a pd
+    Series with a gap of a year.
+    """
+    rng = np.random.RandomState(seed)
+    timestamps = np.sort(rng.randint(0, size * 3600000, size)) + 10**12
+    values = sample_series(size, seed)
+    gap = 10**12 + size * 1800000
+    keep = (timestamps < gap) | (timestamps > gap + 365 * 86400000)
+    return pd.Series(values[keep], index=pd.DatetimeIndex(
+        timestamps[keep].astype('datetime64[ms]')))
+
+
+def _load_reference(data, frequency):
+    return data.resample(frequency).mean().interpolate(
+        method='linear')[data.index[0]:data.index[-1]]
+
+
+def _ts_to_dict_reference(results):
+    stats1 = ('min', 'max', 'sum', 'count')
+    stats2 = ((0, 'min'), (1, 'max'), (2, 'mean'), (3, 'range (max - min)'),
+              (4, 'difference (last - first)'),
+              (5, 'difference (mean last - first year)'))
+    ts = []
+    for result in results:
+        try:
+            timestamps = [int(result['first_value_timestamp']),
+                          int(result['last_value_timestamp'])]
+        except (ValueError, TypeError):
+            timestamps = [np.nan, np.nan]
+        if not len(result['events']):
+            ts.append([np.nan for _ in range(len(stats1))] + timestamps)
+        else:
+            ts.append([float(result['events'][0][s]) for s in stats1] +
+                      timestamps)
+    npts = np.array(ts)
+    npts_calculated = np.hstack((
+        npts[:, 0:2],
+        (npts[:, 2] / npts[:, 3]).reshape(-1, 1),
+        (npts[:, 1] - npts[:, 0]).reshape(-1, 1),
+        npts[:, 4:]
+    ))
+    values = {}
+    for i, row in enumerate(npts_calculated):
+        location_uuid = results[i]['location']['uuid']
+        loc_dict = values.get(location_uuid, {})
+        loc_dict.update({stat: 'NaN' if np.isnan(row[i]) else row[i]
+                         for i, stat in stats2})
+        loc_dict['timeseries_uuid'] = results[i]['uuid']
+        values[location_uuid] = loc_dict
+    return values, np.nanmin(npts_calculated, 0), \
+        np.nanmax(npts_calculated, 0)
+
+
+def _js_dates_reference(js_dates, index):
+    dates = np.array(
+        [jsdatetime.js_to_datestring(x, iso=True) for x in js_dates],
+        dtype='datetime64'
+    )
+    return dates, [jsdatetime.datetime_to_js(x) for x in index]
+
+
+def _chart_values_reference(npseries, index):
+    return [{'x': jsdatetime.datetime_to_js(index[i]), 'y': float(value)}
+            for i, value in enumerate(npseries)]
+
+
+# ---------------------------------------------------------------------------- #
+### Benchmarks
+
+
+def harmonic(sizes=(10**3, 10**4, 10**5, 10**6), n_harmonics=3):
+    """
+    freq_calculator.harmonic against the list comprehension implementation.
+    """
+    rows = []
+    for size in sizes:
+        data = sample_series(size)
+        reference = best_of(lambda: _harmonic_reference(data, n_harmonics))
+        current = best_of(lambda: calculator.harmonic(data, n_harmonics))
+        rows.append((size, reference, current))
+    return rows
+
+
+def autoregressive(sizes=(10**3, 10**4, 10**5), max_order=10):
+    """
+    freq_calculator.autoregressive_orders (all orders in one Levinson-Durbin
+    recursion) against a statsmodels AutoReg fit per order.
+    """
+    rows = []
+    for size in sizes:
+        data = sample_series(size)
+        reference = best_of(lambda: _autoregressive_reference(data,
+                                                              max_order))
+        current = best_of(lambda: calculator.autoregressive_orders(
+            data, max_order))
+        rows.append((size, reference, current))
+    return rows
+
+
+def correlogram(sizes=(10**3, 10**4, 10**5), n_lags=365):
+    """
+    freq_calculator.correlogram with FFTs against the lag matrix and the
+    full correlation matrix.
+    """
+    rows = []
+    for size in sizes:
+        data = sample_series(size)
+        lags = min(n_lags, size // 2)
+        reference = best_of(lambda: _correlogram_reference(data, lags))
+        current = best_of(lambda: calculator.correlogram(data, lags))
+        rows.append((size, reference, current))
+    return rows
+
+
+def mann_kendall(sizes=(10**3, 3 * 10**3, 10**4)):
+    """
+    freq_calculator.mann_kendall (S by inversion counting, Sen's slope by
+    bisection) against the S statistic and the median over all pairs.
+    """
+    rows = []
+    for size in sizes:
+        data = sample_series(size)
+        reference = best_of(lambda: _mann_kendall_reference(data), repeat=1)
+        current = best_of(lambda: calculator.mann_kendall(data, 0.05),
+                          repeat=1)
+        rows.append((size, reference, current))
+    return rows
+
+
+def load(sizes=(10**4, 10**5, 10**6)):
+    """
+    freq_calculator.load (monthly means by bincount, gaps filled by
+    np.interp) against pandas resample and interpolate.
+    """
+    rows = []
+    for size in sizes:
+        data = sample_observations(size)
+        reference = best_of(lambda: _load_reference(data, 'ME'))
+        current = best_of(lambda: calculator.load(data=data, frequency='M'))
+        rows.append((size, reference, current))
+    return rows
+
+
+def parallel_run(sizes=(64, 256, 1024), length=600):
+    """
+    freq.parallel.run over all cores against a serial loop over the series.
+    Size is the number of series.
+    """
+    rows = []
+    for size in sizes:
+        series = [sample_series(length + seed % 120, seed=seed)
+                  for seed in range(size)]
+        reference = best_of(lambda: parallel.run(series, processes=1),
+                            repeat=1)
+        current = best_of(lambda: parallel.run(series), repeat=1)
+        rows.append((size, reference, current))
+    return rows
+
+
+def ts_to_dict(sizes=(10**4, 10**5)):
+    """
+    TimeSeries.ts_to_dict against the row by row implementation. Size is the
+    number of locations.
+    """
+    rows = []
+    for size in sizes:
+        timeseries = lizard_connector.TimeSeries()
+        timeseries.results = sample_results(size)
+        reference = best_of(lambda: _ts_to_dict_reference(timeseries.results))
+        current = best_of(lambda: timeseries.ts_to_dict(
+            start_date=0, end_date=2 * 10**12))
+        rows.append((size, reference, current))
+    return rows
+
+
+def js_dates(sizes=(10**4, 10**5)):
+    """
+    Array conversions between js timestamps and dates against the per date
+    conversions through strings and datetimes. Both directions are timed.
+    """
+    rows = []
+    for size in sizes:
+        js = np.arange(size, dtype=np.int64) * 86400000 + 43200000
+        index = pd.date_range('1990-01-01', periods=size, freq='D')
+        reference = best_of(lambda: _js_dates_reference(js.tolist(), index))
+        current = best_of(lambda: (jsdatetime.js_to_datetime64(js.tolist()),
+                                   jsdatetime.datetime64_to_js(index)))
+        rows.append((size, reference, current))
+    return rows
+
+
+def renderer(sizes=(10**3, 10**4, 10**5)):
+    """
+    Building and rendering a trend and a map response with NumpyJSONRenderer
+    against per element float conversion and the JSONRenderer of the rest
+    framework. Size is the number of points per series and of locations.
+    """
+    django_settings()
+    from rest_framework.renderers import JSONRenderer
+    from freq import renderers
+
+    def current_chart_values(data, index):
+        return renderers.ChartValues(jsdatetime.datetime64_to_js(index), data)
+
+    rows = []
+    for size in sizes:
+        timeseries = lizard_connector.TimeSeries()
+        timeseries.results = sample_results(size)
+        map_payload = {'timeseries': timeseries.ts_to_dict(
+            start_date=0, end_date=2 * 10**12)}
+        reference = best_of(lambda: JSONRenderer().render(
+            [trend_payload(size, _chart_values_reference), map_payload]))
+        current = best_of(lambda: renderers.NumpyJSONRenderer().render(
+            [trend_payload(size, current_chart_values), map_payload]))
+        rows.append((size, reference, current))
+    return rows
+
+
+BENCHMARKS = {
+    'autoregressive': autoregressive,
+    'correlogram': correlogram,
+    'harmonic': harmonic,
+    'js_dates': js_dates,
+    'load': load,
+    'mann_kendall': mann_kendall,
+    'parallel': parallel_run,
+    'renderer': renderer,
+    'ts_to_dict': ts_to_dict,
+}
+
+
+def main(names=None):
+    for name in names or sorted(BENCHMARKS):
+        print(name)
+        print('{:>10} {:>12} {:>12} {:>8}'.format(
+            'size', 'reference', 'current', 'speedup'))
+        for size, reference, current in BENCHMARKS[name]():
+            print('{:>10} {:>11.4f}s {:>11.4f}s {:>7.1f}x'.format(
+                size, reference, current, reference / current))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,235 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+In-process caches shared by all views, and the organisations of users in
+the django cache.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+import numpy as np
+import pandas as pd
+
+from freq.lizard_connector import GroundwaterTimeSeries
+from freq.lizard_connector import Users
+from freq.timeseries_store import TimeSeriesStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache with a time to live.
+    :param maxsize: maximum number of entries, the least recently used entry
+                    is evicted when it is exceeded.
+    :param ttl: seconds an entry stays valid after it was set.
+    """
+
+    def __init__(self, maxsize=128, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < time.time():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """
+        :return: the cached value for key, calls func to create it if it is
+                 not cached (yet).
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+TIMESERIES_CACHE = LRUCache(
+    maxsize=getattr(settings, 'TIMESERIES_CACHE_SIZE', 128),
+    ttl=getattr(settings, 'TIMESERIES_CACHE_TTL', 600)
+)
+STAGE_CACHE = LRUCache(
+    maxsize=getattr(settings, 'STAGE_CACHE_SIZE', 256),
+    ttl=getattr(settings, 'STAGE_CACHE_TTL', 600)
+)
+# created on first use, see timeseries_store
+TIMESERIES_STORE = None
+
+
+def events_to_arrays(events, value_field='max'):
+    """
+    Converts a list of Lizard events to compact numpy arrays.
+    :return: int64 array of js timestamps and float64 array of values, None
+             values become NaN.
+    """
+    timestamps = np.fromiter((event['timestamp'] for event in events),
+                             dtype=np.int64, count=len(events))
+    values = np.array([event[value_field] for event in events],
+                      dtype=np.float64)
+    return timestamps, values
+
+
+def download_events(ts_uuid, start=None, end=None, organisation=None,
+                    use_header=False):
+    """
+    Downloads the events of a groundwater timeseries.
+    :param start: start of the events, None for all events.
+    :return: int64 array of js timestamps and float64 array of values.
+    """
+    ts = GroundwaterTimeSeries(use_header=use_header)
+    window = {'start': start} if start is not None else {}
+    ts.uuid(ts_uuid=ts_uuid, end=end, organisation=organisation,
+            events_field='max', **window)
+    if ts.events:
+        return ts.events[0]
+    return events_to_arrays([])
+
+
+def timeseries_store():
+    """
+    The local store of timeseries events, when TIMESERIES_STORE_DIR is set.
+    """
+    global TIMESERIES_STORE
+    directory = getattr(settings, 'TIMESERIES_STORE_DIR', None)
+    if TIMESERIES_STORE is None and directory:
+        TIMESERIES_STORE = TimeSeriesStore(
+            directory, download_events,
+            revalidate=getattr(settings, 'TIMESERIES_STORE_REVALIDATE', None))
+    return TIMESERIES_STORE
+
+
+def store_events(events, organisation=None, use_header=False):
+    """
+    Stores the complete events of timeseries in the timeseries store, when
+    there is one.
+    :param events: iterable of (ts_uuid, timestamps, values).
+    """
+    store = timeseries_store()
+    if store is not None:
+        store.put(events, organisation, use_header)
+
+
+def timeseries_events(ts_uuid, start, end=None, organisation=None,
+                      use_header=False):
+    """
+    Events of a groundwater timeseries, downloaded once per time window.
+    With a timeseries store only the new events are downloaded.
+    :return: int64 array of js timestamps and float64 array of values.
+    """
+    def fetch():
+        store = timeseries_store()
+        if store is not None:
+            timestamps, values = store.events(
+                ts_uuid, start, end, organisation, use_header)
+        else:
+            timestamps, values = download_events(
+                ts_uuid, start, end, organisation, use_header)
+        # cached arrays are shared between requests
+        timestamps.flags.writeable = False
+        values.flags.writeable = False
+        return timestamps, values
+
+    key = (ts_uuid, start, end, organisation, use_header)
+    return TIMESERIES_CACHE.get_or_set(key, fetch)
+
+
+def array_key(data):
+    """
+    Content hash of a numpy array or pandas Series (including its name and
+    index).
+    """
+    digest = hashlib.sha1()
+    array = np.ascontiguousarray(data)
+    digest.update('{0}{1}'.format(array.dtype, array.shape).encode())
+    digest.update(array.tobytes())
+    if isinstance(data, pd.Series):
+        # the dtype of a DatetimeIndex includes its unit and timezone
+        digest.update('{0!r}{1}'.format(data.name, data.index.dtype).encode())
+        digest.update(np.ascontiguousarray(data.index.values).tobytes())
+    return digest.hexdigest()
+
+
+def cached_stage(func, **parameters):
+    """
+    Calls func with keyword arguments parameters, once per content.
+    Array and Series arguments are keyed by a hash of their content, so a
+    stage only reruns when its own parameters or its upstream data changed.
+    Results are shared and should not be modified.
+    """
+    key = (func.__module__, func.__qualname__) + tuple(
+        (name, array_key(value) if isinstance(value, (np.ndarray, pd.Series))
+         else value)
+        for name, value in sorted(parameters.items())
+    )
+    return STAGE_CACHE.get_or_set(key, lambda: func(**parameters))
+
+
+def organisations_key(username):
+    return 'freq:organisations:' + hashlib.sha1(
+        str(username).encode()).hexdigest()
+
+
+def organisations_cache():
+    return caches[getattr(settings, 'ORGANISATIONS_CACHE', 'default')]
+
+
+def user_organisations(username):
+    """
+    Organisations of a lizard user, looked up once per
+    ORGANISATIONS_CACHE_TTL in the (shared) django cache ORGANISATIONS_CACHE.
+    :return: list of (name, unique_id) tuples, see Users.get_organisations.
+    """
+    key = organisations_key(username)
+    organisations = organisations_cache().get(key)
+    if organisations is None:
+        organisations = Users(use_header=True).get_organisations(
+            username=username)
+        organisations_cache().set(
+            key, organisations,
+            getattr(settings, 'ORGANISATIONS_CACHE_TTL', 3600))
+    return organisations
+
+
+def invalidate_organisations(username):
+    """
+    Removes the cached organisations of a user, they are looked up again on
+    the next request.
+    """
+    organisations_cache().delete(organisations_key(username))
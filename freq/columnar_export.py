@@ -0,0 +1,134 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Columnar export of the result of a csv task, as an alternative to the csv.
+
+The export is a zip archive with two tables, in Parquet or Arrow IPC stream
+format:
+
+- timeseries: uuid, name, location_name, x and y of every timeseries.
+- events: uuid (dictionary encoded), timestamp (UTC, milliseconds) and value
+  (float64, null for missing values) of every event.
+
+The archive is written while it is sent, one record batch per block of
+spooled events. Requires pyarrow.
+"""
+import zipfile
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+
+FORMATS = ('parquet', 'arrow')
+
+
+def available():
+    return pa is not None
+
+
+class ChunkWriter(object):
+    """
+    Write-only file-like object that collects the written bytes until they
+    are taken.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def timeseries_schema():
+    return pa.schema([
+        ('uuid', pa.string()),
+        ('name', pa.string()),
+        ('location_name', pa.string()),
+        ('x', pa.float64()),
+        ('y', pa.float64()),
+    ])
+
+
+def events_schema():
+    return pa.schema([
+        ('uuid', pa.dictionary(pa.int32(), pa.string())),
+        ('timestamp', pa.timestamp('ms', tz='UTC')),
+        ('value', pa.float64()),
+    ])
+
+
+def timeseries_table(header):
+    """
+    :param header: iterable of [uuid, name, location_name, x, y] rows.
+    """
+    columns = list(zip(*header)) or [[]] * 5
+    return pa.Table.from_arrays(
+        [pa.array(column, type=field.type)
+         for column, field in zip(columns, timeseries_schema())],
+        schema=timeseries_schema())
+
+
+def events_batch(records, uuids):
+    """
+    :param records: spooled records with index, timestamp and value, see
+                    lizard_connector.TaskAPI.spooled_events.
+    :param uuids: pyarrow string array with the uuids of the timeseries.
+    """
+    return pa.RecordBatch.from_arrays([
+        pa.DictionaryArray.from_arrays(
+            records['index'].astype(np.int32), uuids),
+        pa.array(records['timestamp'], type=pa.timestamp('ms', tz='UTC')),
+        pa.array(records['value'], mask=np.isnan(records['value'])),
+    ], schema=events_schema())
+
+
+def table_writer(sink, schema, file_format):
+    if file_format == 'parquet':
+        return pa.parquet.ParquetWriter(sink, schema)
+    return pa.ipc.new_stream(sink, schema)
+
+
+def export_chunks(header, task, file_format='parquet'):
+    """
+    Writes the timeseries and the spooled events of a finished csv task as a
+    zip archive.
+    :param header: iterable of [uuid, name, location_name, x, y] rows, see
+                   lizard_connector.TaskAPI.timeseries_csv.
+    :param task: TaskAPI with spooled events.
+    :param file_format: 'parquet' or 'arrow'.
+    :return: iterator of the bytes of the archive.
+    """
+    if file_format not in FORMATS:
+        raise ValueError('Unknown export format: {}'.format(file_format))
+    out = ChunkWriter()
+    # members are stored, parquet pages are compressed already
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as archive:
+        with archive.open('timeseries.' + file_format, 'w') as member:
+            with table_writer(member, timeseries_schema(),
+                              file_format) as writer:
+                writer.write_table(timeseries_table(header))
+        yield out.take()
+        uuids = pa.array([r['uuid'] for r in task.results], type=pa.string())
+        with archive.open('events.' + file_format, 'w',
+                          force_zip64=True) as member:
+            with table_writer(member, events_schema(), file_format) as writer:
+                for records in task.spooled_events():
+                    writer.write_table(pa.Table.from_batches(
+                        [events_batch(records, uuids)]))
+                    yield out.take()
+    yield out.take()
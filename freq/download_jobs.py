@@ -0,0 +1,344 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Background jobs for the download of all timeseries of an organisation.
+
+A job starts the csv task in lizard, polls it with backoff in a background
+thread and, when the task succeeded, downloads the result once and writes
+the exports (csv and, when configured and pyarrow is installed, the zipped
+Parquet and Arrow tables) to disk. The state of every job is a small JSON
+status record next to the exports, so views only read a local file instead
+of polling lizard and every process of the site sees the same jobs. A
+running job updates its record regularly, a lock file keeps processes from
+starting the same job twice.
+"""
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from freq import columnar_export
+from freq.cache import store_events
+from freq.lizard_connector import GroundwaterTimeSeries
+from freq.lizard_connector import TaskAPI
+
+
+logger = logging.getLogger(__name__)
+
+
+# status of a job, the first two are the states of the lizard task.
+PENDING = 'PENDING'
+STARTED = 'STARTED'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+# seconds after which the lock file of a job is left by a stopped process
+LOCK_TIMEOUT = 60
+# created on first use, see download_jobs
+DOWNLOAD_JOBS = None
+
+
+def csv_rows(header, event_rows):
+    """
+    :return: iterator of the rows of the csv download: a table of the
+             timeseries, an empty row and a table of the events.
+    """
+    yield ['uuid', 'name', 'location_name', 'x', 'y']
+    for row in header:
+        yield row
+    yield []
+    yield ['name', 'uuid', 'timestamp', 'value']
+    for row in event_rows:
+        yield row
+
+
+class DownloadJobs(object):
+    """
+    Runs download jobs in background threads, one job per organisation and
+    login at a time.
+    :param directory: directory of the status records and exports, created
+                      when missing.
+    :param base: url of the lizard api.
+    :param poll_interval: seconds before the task is polled the first time,
+                          the interval grows by half after every poll.
+    :param max_poll_interval: maximum seconds between two polls.
+    :param max_wait: seconds after which a task that did not finish fails.
+    :param stale_after: seconds without update after which an unfinished job
+                        is considered interrupted (its process stopped),
+                        defaults to four times max_poll_interval.
+    :param ttl: seconds an export is served, after which the download starts
+                again.
+    :param formats: formats of the exports, the csv is always written,
+                    'parquet' and 'arrow' only when pyarrow is installed.
+    """
+
+    def __init__(self, directory, base="https://ggmn.lizard.net",
+                 poll_interval=2, max_poll_interval=30, max_wait=3 * 3600,
+                 stale_after=None, ttl=24 * 3600, formats=('csv',)):
+        self.directory = directory
+        self.base = base
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_wait = max_wait
+        # a running job updates its record at least every max_poll_interval
+        if stale_after is None:
+            stale_after = 4 * max_poll_interval
+        self.stale_after = max(stale_after, 2 * max_poll_interval)
+        self.ttl = ttl
+        unknown = set(formats) - {'csv'} - set(columnar_export.FORMATS)
+        if unknown:
+            raise ValueError('Unknown export formats: {}'.format(
+                ', '.join(sorted(unknown))))
+        self.formats = tuple(formats)
+        self._threads = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def digest(organisation, use_header):
+        return hashlib.sha1(
+            repr((organisation, use_header)).encode()).hexdigest()
+
+    def path(self, digest, suffix):
+        return os.path.join(self.directory, digest + suffix)
+
+    def export_path(self, job, file_format='csv'):
+        """
+        :return: path of the export of a finished job in file_format, None
+                 when it was not written.
+        """
+        filename = job.get('files', {}).get(file_format)
+        return os.path.join(self.directory, filename) if filename else None
+
+    def write_atomic(self, path, write, mode='wb'):
+        # written to a temporary file first, so readers never see half a file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def acquire(self, digest):
+        """
+        Creates the lock file of a job, which fails while another thread or
+        process holds it. Locks older than LOCK_TIMEOUT are broken.
+        :return: whether the lock was acquired.
+        """
+        path = self.path(digest, '.lock')
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(path).st_mtime < LOCK_TIMEOUT:
+                        return False
+                    os.remove(path)
+                except OSError:
+                    # released or broken by another process meanwhile
+                    pass
+        return False
+
+    def release(self, digest):
+        try:
+            os.remove(self.path(digest, '.lock'))
+        except OSError:
+            pass
+
+    def status(self, organisation, use_header=False):
+        """
+        :return: the status record of the job of an organisation, None when
+                 there is no job or its export expired. A job that stopped
+                 updating its record has status FAILURE.
+        """
+        digest = self.digest(organisation, use_header)
+        try:
+            with open(self.path(digest, '.json')) as f:
+                job = json.load(f)
+        except (IOError, ValueError):
+            return None
+        now = time.time()
+        if job['status'] == SUCCESS and now - job['finished'] > self.ttl:
+            return None
+        if job['status'] not in (SUCCESS, FAILURE) and \
+                now - job['updated'] > self.stale_after:
+            job['status'] = FAILURE
+            job['message'] = 'Download interrupted.'
+        return job
+
+    def update(self, job, **fields):
+        job.update(fields, updated=time.time())
+        self.write_atomic(
+            self.path(job['id'], '.json'),
+            lambda f: f.write(json.dumps(job)), mode='w')
+        return job
+
+    def start(self, organisation, use_header=False):
+        """
+        Starts the download of all timeseries of an organisation, unless it
+        is running or its export is ready.
+        :return: the status record of the job.
+        """
+        digest = self.digest(organisation, use_header)
+        with self._lock:
+            if not self.acquire(digest):
+                # another process is starting the job
+                return self.status(organisation, use_header)
+            try:
+                thread = self._threads.get(digest)
+                job = self.status(organisation, use_header)
+                if (thread is not None and thread.is_alive()) or (
+                        job is not None and job['status'] != FAILURE):
+                    return job
+                now = time.time()
+                job = self.update({
+                    'id': digest,
+                    'organisation': organisation,
+                    'use_header': use_header,
+                    'status': PENDING,
+                    'message': 'Starting download.',
+                    'started': now,
+                    'finished': None,
+                    'files': {},
+                })
+                thread = threading.Thread(target=self.run,
+                                          args=(dict(job),),
+                                          name='download-' + digest[:8])
+                thread.daemon = True
+                self._threads[digest] = thread
+                thread.start()
+            finally:
+                self.release(digest)
+        return job
+
+    def heartbeat(self, job):
+        """
+        :return: function to call while a job is working, it updates the
+                 status record when it was not updated for max_poll_interval
+                 seconds, so the job does not look interrupted.
+        """
+        def beat():
+            if time.time() - job['updated'] > self.max_poll_interval:
+                self.update(job)
+        return beat
+
+    def heartbeats(self, job, iterable):
+        """
+        :return: iterator of the items of iterable, with a heartbeat of job
+                 for every item.
+        """
+        beat = self.heartbeat(job)
+        for item in iterable:
+            beat()
+            yield item
+
+    def run(self, job):
+        """
+        Runs a job: starts the lizard task, waits for it and writes the
+        exports of its result.
+        """
+        try:
+            task_url, extra_queries = self.start_task(
+                job['organisation'], job['use_header'])
+            task = self.wait(job, task_url)
+            if task.status != SUCCESS:
+                self.update(job, status=FAILURE, finished=time.time(),
+                            message='Download failed.')
+                return
+            self.update(job, status=STARTED,
+                        message='Preparing the download.')
+            header = list(task.timeseries_header(
+                organisation=job['organisation'],
+                extra_queries_ts=extra_queries,
+                progress=self.heartbeat(job)))
+            # the task holds all events, later views read them from the store
+            store_events(self.heartbeats(job, task.timeseries_events()),
+                         organisation=job['organisation'],
+                         use_header=job['use_header'])
+            files = self.write_exports(job, header, task)
+            self.update(job, status=SUCCESS, finished=time.time(),
+                        files=files, message='')
+        except Exception as e:
+            logger.exception('Download of organisation %s failed',
+                             job['organisation'])
+            self.update(job, status=FAILURE, finished=time.time(),
+                        message='Download failed: {}'.format(e))
+
+    def start_task(self, organisation, use_header):
+        """
+        Starts the csv task in lizard.
+        :return: the url of the task and the extra queries of the timeseries.
+        """
+        ts = GroundwaterTimeSeries(self.base, use_header=use_header)
+        return ts.start_csv_task(organisation=organisation)
+
+    def wait(self, job, task_url):
+        """
+        Polls a lizard task until it finished (or max_wait passed), with a
+        growing interval. The status record is updated after every poll.
+        :return: the TaskAPI of the task.
+        """
+        task = TaskAPI(self.base, use_header=job['use_header'])
+        interval = self.poll_interval
+        deadline = time.time() + self.max_wait
+        while True:
+            time.sleep(interval)
+            task.poll(url=task_url)
+            status = task.status
+            if status in (SUCCESS, FAILURE):
+                return task
+            if time.time() > deadline:
+                raise TimeoutError('Task did not finish in time.')
+            self.update(job, status=STARTED if status == STARTED else PENDING)
+            interval = min(interval * 1.5, self.max_poll_interval)
+
+    def write_exports(self, job, header, task):
+        """
+        Writes the csv and, when pyarrow is installed, the zipped Parquet and
+        Arrow exports in formats of a finished task.
+        :return: dictionary with the filename by format.
+        """
+        digest = job['id']
+        files = {}
+
+        def write_csv(f):
+            text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+            csv.writer(text).writerows(csv_rows(
+                header, self.heartbeats(job, task.csv_rows())))
+            text.detach()
+
+        files['csv'] = digest + '.csv'
+        self.write_atomic(self.path(digest, '.csv'), write_csv)
+        if columnar_export.available():
+            for file_format in columnar_export.FORMATS:
+                if file_format not in self.formats:
+                    continue
+                files[file_format] = digest + '_' + file_format + '.zip'
+                self.write_atomic(
+                    os.path.join(self.directory, files[file_format]),
+                    lambda f: f.writelines(self.heartbeats(
+                        job, columnar_export.export_chunks(
+                            header, task, file_format))))
+        return files
+
+
+def download_jobs():
+    """
+    The download job runner, with its records in DOWNLOAD_JOBS_DIR.
+    """
+    global DOWNLOAD_JOBS
+    if DOWNLOAD_JOBS is None:
+        DOWNLOAD_JOBS = DownloadJobs(
+            getattr(settings, 'DOWNLOAD_JOBS_DIR', None) or os.path.join(
+                tempfile.gettempdir(), 'freq-downloads'),
+            **getattr(settings, 'DOWNLOAD_JOBS', {}))
+    return DOWNLOAD_JOBS
@@ -0,0 +1,181 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Streaming decoder for lizard timeseries responses.
+
+A timeseries response can hold hundreds of thousands of events. Decoding it
+with json.loads builds a dict per event for the whole response; this decoder
+reads the response in chunks and collects the events into numpy arrays, only
+the small remainder of the document (the metadata) is decoded as JSON. The
+events of a chunk are decoded together, so only the dicts of one chunk exist
+at a time and memory is bounded by the chunk size.
+"""
+import codecs
+import json
+import re
+
+import numpy as np
+
+
+EVENTS_KEY = re.compile(r'"events"\s*:\s*\[')
+WHITESPACE = ' \t\n\r,'
+# enough characters to hold the start of an events key split over two chunks
+OVERLAP = 64
+
+
+class EventArrays(object):
+    """
+    Growable pair of timestamp (int64, js milliseconds) and value (float64)
+    arrays.
+    """
+
+    def __init__(self, capacity=4096):
+        self.size = 0
+        self.timestamps = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty(capacity, dtype=np.float64)
+
+    def extend(self, timestamps, values):
+        """
+        Appends lists of timestamps and values, None values become NaN.
+        """
+        size = self.size + len(timestamps)
+        if size > len(self.timestamps):
+            capacity = max(size, 2 * len(self.timestamps))
+            self.timestamps = np.resize(self.timestamps, capacity)
+            self.values = np.resize(self.values, capacity)
+        self.timestamps[self.size:size] = timestamps
+        self.values[self.size:size] = np.array(values, dtype=np.float64)
+        self.size = size
+
+    def arrays(self):
+        """
+        :return: the timestamps and values arrays trimmed to their size.
+        """
+        return self.timestamps[:self.size].copy(), \
+            self.values[:self.size].copy()
+
+
+def _escaped(text, index):
+    """
+    :return: whether the character at index is escaped by backslashes.
+    """
+    backslashes = 0
+    while index - backslashes > 0 and text[index - backslashes - 1] == '\\':
+        backslashes += 1
+    return backslashes % 2 == 1
+
+
+class EventStream(object):
+    """
+    Iterates over the events of a JSON response while it is read.
+    Iteration yields (index, timestamps, values) batches, index is the number
+    of the events array in document order. After the iteration the document
+    attribute holds the decoded document, in which every events array is
+    empty and n_arrays the number of events arrays.
+    :param stream: file-like object with a read(size) method returning bytes.
+    :param value_field: field of the events used as value.
+    :param encoding: character encoding of the response.
+    :param chunk_size: number of bytes read at once.
+    """
+
+    def __init__(self, stream, value_field='max', encoding='utf-8',
+                 chunk_size=2**16):
+        self.stream = stream
+        self.value_field = value_field
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.document = None
+        self.n_arrays = 0
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        json_decoder = json.JSONDecoder()
+        skeleton = []
+        index = -1
+        in_events = False
+        buf = ''
+        eof = False
+        while True:
+            if not eof:
+                chunk = self.stream.read(self.chunk_size)
+                eof = not chunk
+                buf += decoder.decode(chunk or b'', final=eof)
+            pos = 0
+            while True:
+                if not in_events:
+                    match = EVENTS_KEY.search(buf, pos)
+                    while match and _escaped(buf, match.start()):
+                        match = EVENTS_KEY.search(buf, match.start() + 1)
+                    if match is None:
+                        keep = 0 if eof else min(OVERLAP, len(buf) - pos)
+                        skeleton.append(buf[pos:len(buf) - keep])
+                        pos = len(buf) - keep
+                        break
+                    skeleton.append(buf[pos:match.end()])
+                    pos = match.end()
+                    index += 1
+                    in_events = True
+                else:
+                    while pos < len(buf) and buf[pos] in WHITESPACE:
+                        pos += 1
+                    if pos == len(buf):
+                        break
+                    if buf[pos] == ']':
+                        skeleton.append(']')
+                        pos += 1
+                        in_events = False
+                        continue
+                    # Events are flat objects: decode all complete events in
+                    # the buffer at once and fall back to one by one decoding
+                    # for events with braces or brackets in strings.
+                    end = buf.find(']', pos)
+                    end = buf.rfind('}', pos, len(buf) if end < 0 else end) + 1
+                    try:
+                        if end <= pos:
+                            raise ValueError('No complete event in buffer')
+                        batch = json.loads('[' + buf[pos:end] + ']')
+                    except ValueError:
+                        try:
+                            event, end = json_decoder.raw_decode(buf, pos)
+                        except ValueError:
+                            if eof:
+                                raise
+                            # the event continues in the next chunk
+                            break
+                        batch = [event]
+                    yield (index,
+                           [event['timestamp'] for event in batch],
+                           [event[self.value_field] for event in batch])
+                    pos = end
+            buf = buf[pos:]
+            if eof:
+                break
+        if in_events:
+            raise ValueError('Unterminated events array')
+        self.document = json.loads(''.join(skeleton))
+        self.n_arrays = index + 1
+
+
+def decode_events(stream, value_field='max', encoding='utf-8',
+                  chunk_size=2**16):
+    """
+    Decodes a JSON response, collecting every "events" array into numpy
+    arrays.
+    :param stream: file-like object with a read(size) method returning bytes.
+    :param value_field: field of the events used as value.
+    :param encoding: character encoding of the response.
+    :param chunk_size: number of bytes read at once.
+    :return: the decoded document, in which every events array is empty, and
+             a list of (timestamps, values) tuples with the events of every
+             events array in document order.
+    """
+    events = EventStream(stream, value_field, encoding, chunk_size)
+    arrays = []
+    for index, timestamps, values in events:
+        while len(arrays) <= index:
+            arrays.append(EventArrays())
+        arrays[index].extend(timestamps, values)
+    # empty events arrays yield no batches
+    while len(arrays) < events.n_arrays:
+        arrays.append(EventArrays())
+    return events.document, [array.arrays() for array in arrays]
@@ -12,12 +12,12 @@ Contains the modules for monitoring of groundwater networks
 V 0.0 - Implementation in single file of complete FREQ library.
 
 """
+from collections import OrderedDict
 import logging
 
 import numpy as np
 import pandas as pd
 import scipy.stats as st
-import statsmodels.api as sts
 
 
 logger = logging.getLogger(__name__)
@@ -25,13 +25,120 @@ logger = logging.getLogger(__name__)
 
 MIN_SAMPLES = 40
 ERROR_CODE = -9999
+MS_PER_DAY = 86400000
+# pandas aliases of the frequencies resampled with numpy, see resample
+RESAMPLE_FREQUENCIES = {'M': 'M', 'ME': 'M', 'W': 'W', 'W-SUN': 'W',
+                        'D': 'D'}
 
 class CalculatorSampleAmountError(Exception):
     pass
 
 
+def _calendar_bins(frequency):
+    '''
+    Calendar bins: days (D), weeks from Monday to Sunday (W) or months (M).
+    Returns functions giving the bin numbers of timestamps and the start and
+    the label (the day, the Sunday or the last day of the month, as labelled
+    by pandas) of bin numbers, all times in milliseconds since epoch.
+    '''
+    if frequency == 'M':
+        def bins(timestamps):
+            # months are looked up per day, far fewer than the timestamps
+            days = timestamps // MS_PER_DAY
+            first = days.min()
+            months = np.arange(first, days.max() + 1).astype(
+                'datetime64[D]').astype('datetime64[M]').astype(np.int64)
+            return months[days - first]
+
+        def start(bins):
+            return bins.astype('datetime64[M]').astype(
+                'datetime64[ms]').astype(np.int64)
+        return bins, start, lambda bins: start(bins + 1) - MS_PER_DAY
+    if frequency == 'W':
+        # 1970-01-01 is a Thursday, week 0 runs from 1969-12-29 to 1970-01-04
+        return (lambda timestamps: (timestamps // MS_PER_DAY + 3) // 7,
+                lambda bins: (7 * bins - 3) * MS_PER_DAY,
+                lambda bins: (7 * bins + 3) * MS_PER_DAY)
+    return (lambda timestamps: timestamps // MS_PER_DAY,
+            lambda bins: bins * MS_PER_DAY,
+            lambda bins: bins * MS_PER_DAY)
+
+
+def resample(timestamps, values, frequency='M', max_gap=None):
+    '''
+    Resample observations to their calendar means and linearly interpolate
+    the empty bins
+
+    Equivalent to pandas' resample(frequency).mean().interpolate('linear')
+    on arrays. Sorted observations are summed per slice between the starts
+    of the bins (found by np.searchsorted), other observations by
+    np.bincount of their bin numbers. Gaps are filled by np.interp between
+    the bins around them.
+
+    Parameters
+    ----------
+    timestamps : array_like
+        Times of the observations in milliseconds since epoch (UTC)
+    values : array_like
+        Values of the observations, NaN values are ignored
+    frequency : str
+        'M' (months), 'W' (weeks ending on Sunday) or 'D' (days), or their
+        pandas aliases in RESAMPLE_FREQUENCIES
+    max_gap : int
+        Maximum number of consecutive empty bins that is interpolated, longer
+        gaps stay NaN. None interpolates all gaps.
+
+    Returns
+    -------
+    labels : nd_array
+        Labels of all bins from the first to the last observation, in
+        milliseconds since epoch
+    resampled : nd_array
+        Mean of the observations in every bin. Empty bins are interpolated,
+        except before the first value. After the last value the last mean
+        is repeated.
+    '''
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    bins_of, start, label = _calendar_bins(RESAMPLE_FREQUENCIES[frequency])
+    valid = ~np.isnan(values)
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        first, last = bins_of(timestamps[[0, -1]])
+        n_bins = int(last - first) + 1
+        bounds = np.searchsorted(timestamps,
+                                 start(np.arange(first, last + 1)))
+        counts = np.diff(np.append(0, np.cumsum(valid))[
+            np.append(bounds, len(valid))])
+        # the sum of an empty slice is the next value, but it is not used
+        sums = np.add.reduceat(np.where(valid, values, 0.), bounds)
+    else:
+        bins = bins_of(timestamps)
+        first = bins.min()
+        n_bins = int(bins.max() - first) + 1
+        bins = bins[valid] - first
+        counts = np.bincount(bins, minlength=n_bins)
+        sums = np.bincount(bins, weights=values[valid], minlength=n_bins)
+    filled = np.flatnonzero(counts)
+    resampled = np.full(n_bins, np.nan)
+    resampled[filled] = sums[filled] / counts[filled]
+
+    if len(filled) and len(filled) < n_bins:
+        resampled = np.interp(np.arange(n_bins), filled, resampled[filled])
+        resampled[:filled[0]] = np.nan
+        if max_gap is not None:
+            # size of the gap of every empty bin, from the filled bins around
+            # it; after the last filled bin the gap has no end
+            empty = np.flatnonzero(counts == 0)
+            after = np.searchsorted(filled, empty)
+            previous = np.append(-1, filled)[after]
+            following = np.append(filled, np.iinfo(np.int64).max)[after]
+            resampled[empty[following - previous - 1 > max_gap]] = np.nan
+    return label(np.arange(first, first + n_bins)), resampled
+
+
 def load(data=None, data_path=None, init_date=None, end_date=None,
-         frequency='M', interpolation_method='linear', delimiter=';'):
+         frequency='M', interpolation_method='linear', delimiter=';',
+         max_gap=None):
     '''
     Load and interpolate the data to be used in the freq model
     
@@ -55,14 +162,23 @@ def load(data=None, data_path=None, init_date=None, end_date=None,
         method used for the interpolation of values between observations
     delimiter : str
         delimiter used in the csv file to separate the fields
-        
+    max_gap : int
+        Maximum number of consecutive empty periods that is interpolated,
+        longer gaps stay NaN. None interpolates all gaps.
+
     Returns
     -------
-    
+
     data_out : pd DataFrame
         Dataframe interpolated at the requested frequency
     data_mod : nd_array
         Field of values corresponding at the output dataframe
+
+    Notes
+    -----
+    Linear interpolation at the frequencies in RESAMPLE_FREQUENCIES (of
+    timezone naive data) is done by resample, other methods and frequencies
+    by pandas.
     '''
     
     if data is None:
@@ -82,8 +198,21 @@ def load(data=None, data_path=None, init_date=None, end_date=None,
     if end_date is None:
         end_date = data.index[-1]
         
-    data_out = data.resample(frequency, 'mean').interpolate(
-                             method=interpolation_method)[init_date:end_date]
+    if frequency in RESAMPLE_FREQUENCIES and \
+            interpolation_method == 'linear' and data.index.tz is None:
+        labels, resampled = resample(
+            data.index.values.astype('datetime64[ms]').astype(np.int64),
+            data.values, frequency=frequency, max_gap=max_gap)
+        data_out = pd.Series(resampled, name=data.name, index=pd.DatetimeIndex(
+            labels.astype('datetime64[ms]'), name=data.index.name))
+    elif max_gap is not None:
+        raise ValueError('max_gap requires linear interpolation at one of '
+                         'the frequencies {0}'.format(
+                             sorted(RESAMPLE_FREQUENCIES)))
+    else:
+        data_out = data.resample(frequency).mean().interpolate(
+            method=interpolation_method)
+    data_out = data_out[init_date:end_date]
     data_mod = np.array(data_out)
     
     return data_out, data_mod
@@ -177,6 +306,71 @@ def step(data, bp, alpha, detrend_anyway=True):
     return det_serie, trend, param, text_output
 
 
+def step_scan(data, min_size=2):
+    '''
+    Scans all breaking points for a step trend
+    
+    The t-test of step is evaluated for every breaking point at once from
+    cumulative sums and sums of squares, in O(n).
+    
+    Parameters
+    ----------
+    data : array_like
+        Time serries in which the step trend is searched
+    min_size : int
+        Minimal number of values before and after a breaking point
+    
+    Returns
+    -------
+    bp : int
+        Breaking point with the most significant difference in the means
+        (the smallest p-value), 0 for a constant series
+    t_test_vals : nd_array
+        t-test value of every breaking point (0 to len(data)), NaN for
+        breaking points with less than min_size values before or after
+    pvals : nd_array
+        p-value of every breaking point, NaN like t_test_vals
+    '''
+    # Input validation
+    if len(data) < MIN_SAMPLES:
+        raise CalculatorSampleAmountError(
+            'Too little data, dataset has to be larger than {0}'.format(
+                MIN_SAMPLES))
+    if not isinstance(min_size, int) or min_size < 2:
+        raise ValueError('min_size has to be an integer of at least 2')
+
+    data = np.asarray(data, dtype=float)
+    # centred first, the statistics are the same and the sums smaller
+    data = data - data.mean()
+    n_data = len(data)
+    cumsum = np.concatenate(([0.], np.cumsum(data)))
+    cumsum_sq = np.concatenate(([0.], np.cumsum(data**2)))
+    bps = np.arange(min_size, n_data - min_size + 1)
+    n_a = bps.astype(float)
+    n_b = n_data - n_a
+    sum_a = cumsum[bps]
+    sum_b = cumsum[-1] - sum_a
+    # sums of squared deviations from the mean of both parts
+    ss_a = cumsum_sq[bps] - sum_a**2 / n_a
+    ss_b = cumsum_sq[-1] - cumsum_sq[bps] - sum_b**2 / n_b
+    pooled_var = np.maximum(ss_a + ss_b, 0) / (n_data - 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_test_val = (sum_a / n_a - sum_b / n_b) / np.sqrt(
+            pooled_var * (1 / n_a + 1 / n_b))
+    pval = 2 * st.t.sf(np.abs(t_test_val), n_data - 2)
+
+    t_test_vals = np.full(n_data + 1, np.nan)
+    pvals = np.full(n_data + 1, np.nan)
+    t_test_vals[bps] = t_test_val
+    pvals[bps] = pval
+    if np.isnan(t_test_val).all():
+        # constant series, no breaking point is better than another
+        bp = 0
+    else:
+        bp = int(bps[np.nanargmax(np.abs(t_test_val))])
+    return bp, t_test_vals, pvals
+
+
 def linear(data, alpha, detrend_anyway=True):
     '''
     Calculates and remove step trend
@@ -237,7 +431,267 @@ def linear(data, alpha, detrend_anyway=True):
     return det_serie, trend, param, text_output
 
 
-def correlogram(data, n_lags):
+def mann_kendall(data, alpha, detrend_anyway=True):
+    '''
+    Mann-Kendall test for a monotonic trend and removal of the Sen's slope
+    trend
+    
+    The S statistic is computed from the number of inversions (counted with
+    a merge sort) and Sen's slope by bisection with pair counting, both in
+    O(n log n) instead of over all n (n - 1) / 2 pairs.
+    
+    Parameters
+    ----------
+    data : array_like
+        Time serries for which the trend is to be removed
+    alpha : float
+        significance of the Mann-Kendall test (0-1)
+    detrend_anyway : bool
+        Perform the detrend, even if the trend is not significant
+    
+    Returns
+    -------
+    det_serie : nd_array
+        Time series in which the resulting serie is detrended
+    trend : nd_array
+        Trend that was removed from the origincal serie
+    param : list
+        List containing the parameters as: slope, intercept, tau, pval, z, s
+    text_output : str
+        Textual explaination of the results
+    '''
+    # Input validation
+    if alpha > 1.0 or alpha < 0.0:
+        raise ValueError('Alpha value has to be between 0 and 1')
+    if not isinstance(detrend_anyway, bool):
+        raise ValueError('detrend_anyway has to be boolean')
+    if len(data) < MIN_SAMPLES:
+        raise CalculatorSampleAmountError(
+            'Too little data, dataset has to be larger than {0}'\
+                        .format(MIN_SAMPLES))
+
+    data = np.asarray(data, dtype=float)
+    n_data = len(data)
+    n_pairs = n_data * (n_data - 1) // 2
+
+    ## Mann-Kendall S: concordant minus discordant pairs
+    ties = np.unique(data, return_counts=True)[1]
+    s = n_pairs - _tied_pairs(data) - 2 * _inversions(data)
+    var_s = (n_data * (n_data - 1) * (2 * n_data + 5) -
+             (ties * (ties - 1) * (2 * ties + 5)).sum()) / 18.
+    z = (s - np.sign(s)) / np.sqrt(var_s) if var_s > 0 else 0.
+    pval = 2 * st.norm.sf(abs(z))
+    tau = s / float(n_pairs)
+
+    ## Sen's slope and the median intercept
+    x_values = np.arange(n_data)
+    slope = sens_slope(data)
+    intercept = np.median(data - slope * x_values)
+    trend = slope * x_values + intercept
+    det_serie = data - trend
+
+    if alpha <= pval:
+        text_output = 'There is no significant trend at a {0} level of \
+                       confidence\np-value = {1}\nSen\'s slope {2}'.format(
+                                                           alpha, pval, slope)
+        if not detrend_anyway:
+            det_serie = data
+    else:
+        text_output = 'There is a significant trend at a {0} level of \
+                       confidence\np-value = {1}\nSen\'s slope {2}'.format(
+                                                           alpha, pval, slope)
+
+    param = slope, intercept, tau, pval, z, s
+    return det_serie, trend, param, text_output
+
+
+def sens_slope(data, sample_size=10000, seed=0, max_direct=2**20):
+    '''
+    Calculates Sen's slope, the median of the slopes between all pairs of
+    values
+    
+    The median is bracketed by the slopes of a random sample of pairs and
+    the bracket is narrowed by bisection until it holds few pairs, whose
+    slopes are then listed to select the exact median. The number of pairs
+    with a slope below a value is counted in O(n log n), so the slopes of
+    all pairs are never computed.
+    
+    Parameters
+    ----------
+    data : array_like
+        Time series with values at equal intervals
+    sample_size : int
+        Number of random pairs used to bracket the median
+    seed : int
+        Seed of the random pairs
+    max_direct : int
+        Up to this number of pairs the median of all slopes is computed
+        directly
+    
+    Returns
+    -------
+    slope : float
+        Median slope per time step
+    '''
+    data = np.asarray(data, dtype=float)
+    n_data = len(data)
+    n_pairs = n_data * (n_data - 1) // 2
+    if n_pairs == 0:
+        return np.nan
+    if n_pairs <= max_direct:
+        first, second = np.triu_indices(n_data, 1)
+        return np.median((data[second] - data[first]) / (second - first))
+    x_values = np.arange(n_data)
+    # (slope, number of pairs with a smaller or equal slope) of all probes
+    probes = [(-np.inf, 0), (np.inf, n_pairs)]
+
+    def count_below(slope):
+        # slope of pair i < j <= slope when data - slope * x does not
+        # increase from i to j
+        lowered = data - slope * x_values
+        count = _inversions(lowered) + _tied_pairs(lowered)
+        probes.append((slope, count))
+        return count
+
+    rng = np.random.RandomState(seed)
+    first = rng.randint(0, n_data, sample_size)
+    second = rng.randint(0, n_data, sample_size)
+    valid = first != second
+    first, second = first[valid], second[valid]
+    sample = np.sort((data[second] - data[first]) / (second - first))
+    # no slope is steeper than the range of the data
+    spread = np.ptp(data) + 1.
+    count_below(-spread)
+    count_below(spread)
+    q = (n_pairs // 2) / float(n_pairs)
+    # three standard deviations of the sample quantile of the median
+    margin = 3 * np.sqrt(q * (1 - q) / len(sample)) + 1. / len(sample)
+    count_below(sample[max(int((q - margin) * len(sample)), 0)])
+    count_below(sample[min(int(np.ceil((q + margin) * len(sample))),
+                           len(sample) - 1)])
+
+    # pairs listed at most, once the bracket holds so few
+    max_listed = 4 * n_data
+
+    def kth_slope(k):
+        # k-th smallest slope: the bracket of the closest probes is bisected
+        # until it holds few enough slopes to list them
+        lower, below = max(probe for probe in probes if probe[1] < k)
+        upper, up_to = min(probe for probe in probes if probe[1] >= k)
+        while up_to - below > max_listed:
+            middle = (lower + upper) / 2.
+            if middle in (lower, upper):
+                # all slopes in the bracket are equal up to rounding
+                return upper
+            count = count_below(middle)
+            if count >= k:
+                upper, up_to = middle, count
+            else:
+                lower, below = middle, count
+        # pairs with lower < slope <= upper change order between the data
+        # lowered by both slopes, with ties ordered like in count_below
+        order = np.lexsort((-x_values, data - lower * x_values))
+        ranks = np.empty(n_data, dtype=np.int64)
+        ranks[np.lexsort((-x_values, data - upper * x_values))] = x_values
+        first, second = _inverted_pairs(ranks[order])
+        first, second = order[first], order[second]
+        slopes = (data[second] - data[first]) / (second - first)
+        return np.partition(slopes, k - below - 1)[k - below - 1]
+
+    if n_pairs % 2:
+        return kth_slope(n_pairs // 2 + 1)
+    return (kth_slope(n_pairs // 2) + kth_slope(n_pairs // 2 + 1)) / 2.
+
+
+def _tied_pairs(values):
+    """
+    Number of pairs of equal values.
+    """
+    counts = np.unique(values, return_counts=True)[1]
+    return int((counts * (counts - 1) // 2).sum())
+
+
+def _inversions(values):
+    """
+    Number of pairs i < j with values[i] > values[j].
+
+    Counted with a bottom up merge sort of the ranks of the values. Every
+    level merges all pairs of blocks at once: the left blocks, offset per
+    block, form one sorted array in which the values of all right blocks are
+    looked up.
+    """
+    ranks = np.unique(values, return_inverse=True)[1].ravel()
+    # padding ranks larger than all values add no inversions
+    pad_rank = int(ranks.max()) + 1 if len(ranks) else 0
+    n_ranks = pad_rank + 1
+    size = 1 << max(len(ranks) - 1, 0).bit_length()
+    merged = np.full(size, pad_rank, dtype=np.int64)
+    merged[:len(ranks)] = ranks
+    inversions = 0
+    width = 1
+    while width < size:
+        blocks = merged.reshape(-1, 2, width)
+        offsets = (np.arange(len(blocks)) * n_ranks)[:, None]
+        left = (blocks[:, 0] + offsets).ravel()
+        right = (blocks[:, 1] + offsets).ravel()
+        not_greater = np.searchsorted(left, right, side='right') - \
+            np.repeat(np.arange(len(blocks)) * width, width)
+        inversions += int((width - not_greater).sum())
+        # merging two sorted runs is linear with a stable sort
+        merged = np.sort(blocks.reshape(len(blocks), 2 * width), axis=1,
+                         kind='stable').ravel()
+        width *= 2
+    return inversions
+
+
+def _inverted_pairs(values):
+    """
+    Positions of the pairs i < j with values[i] > values[j], for distinct
+    non-negative integers.
+
+    Listed with the bottom up merge sort of _inversions, in
+    O(n log n + number of pairs): every element of a right block is
+    inverted with a suffix of the sorted left block.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    pad_value = int(values.max()) + 1 if len(values) else 0
+    n_values = pad_value + 1
+    size = 1 << max(len(values) - 1, 0).bit_length()
+    merged = np.full(size, pad_value, dtype=np.int64)
+    merged[:len(values)] = values
+    positions = np.arange(size)
+    firsts, seconds = [], []
+    width = 1
+    while width < size:
+        blocks = merged.reshape(-1, 2, width)
+        block_positions = positions.reshape(-1, 2, width)
+        offsets = (np.arange(len(blocks)) * n_values)[:, None]
+        left = (blocks[:, 0] + offsets).ravel()
+        right = (blocks[:, 1] + offsets).ravel()
+        # the suffix of the left block greater than every right element
+        start = np.searchsorted(left, right, side='right')
+        counts = np.repeat(np.arange(1, len(blocks) + 1) * width,
+                           width) - start
+        total = int(counts.sum())
+        steps = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                             counts)
+        firsts.append(block_positions[:, 0].ravel()[
+            np.repeat(start, counts) + steps])
+        seconds.append(np.repeat(block_positions[:, 1].ravel(), counts))
+        order = np.argsort(blocks.reshape(len(blocks), 2 * width), axis=1,
+                           kind='stable')
+        merged = np.take_along_axis(
+            blocks.reshape(len(blocks), 2 * width), order, axis=1).ravel()
+        positions = np.take_along_axis(
+            block_positions.reshape(len(blocks), 2 * width), order,
+            axis=1).ravel()
+        width *= 2
+    if not firsts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def correlogram(data, n_lags, windowed=True):
     '''
     Calculates the correlogram function
     
@@ -247,6 +701,11 @@ def correlogram(data, n_lags):
         Time series for which the step trend is to be removed
     n_lags : int
         Number of lags used for the correlogram computation
+    windowed : bool
+        Correlates the first len(data) - n_lags + 1 values with the values
+        shifted by the lag, each window with its own mean and variance (the
+        estimator of previous versions). Otherwise the standard estimator
+        with the mean and variance of the whole series is used.
     
     Returns
     -------
@@ -260,13 +719,57 @@ def correlogram(data, n_lags):
                         '{1}'.format(len(data), MIN_SAMPLES))
     if not isinstance(n_lags, int) or n_lags < 0:
         raise ValueError('n_lags has to be a positive integer')
-        
-    z = np.zeros((len(data)-n_lags+1, n_lags))
-    for i in range(n_lags):
-        z[:,i] = data[i:len(data) - n_lags + 1 + i]
+    if n_lags >= len(data):
+        raise ValueError('n_lags has to be smaller than the number of '
+                         'samples')
+
+    return _autocorrelation_rows(
+        np.asarray(data, dtype=float)[None, :], n_lags, windowed)[0]
+
+
+def autocorrelation(data, n_lags, alpha=0.05):
+    '''
+    Calculates the autocorrelation and partial autocorrelation functions,
+    with their confidence bands
     
-    corr_vec = np.corrcoef(z, rowvar=0)[0, :]
-    return corr_vec
+    Parameters
+    ----------
+    data : array_like
+        Time series for which the autocorrelation is computed
+    n_lags : int
+        Number of lags (including lag 0)
+    alpha : float
+        Significance level of the confidence bands
+    
+    Returns
+    -------
+    acf : nd_array
+        Autocorrelation of the lags 0 to n_lags - 1
+    pacf : nd_array
+        Partial autocorrelation (Levinson-Durbin) of the lags 0 to n_lags - 1
+    acf_band : nd_array
+        Half width of the confidence band around zero of the autocorrelation
+        of every lag (Bartlett's formula)
+    pacf_band : float
+        Half width of the confidence band around zero of the partial
+        autocorrelation
+
+    Notes
+    -----
+    Uses the standard estimator of the correlogram: the windowed estimator
+    is not a valid autocovariance, its partial autocorrelations and bands
+    would be biased.
+    '''
+    if not isinstance(n_lags, int) or n_lags < 1:
+        raise ValueError('n_lags has to be a positive integer')
+    acf = correlogram(data, n_lags, windowed=False)
+    pacf = _levinson_durbin(acf, max(n_lags - 1, 0))[1][:n_lags]
+    z = st.norm.ppf(1 - alpha / 2.)
+    n_data = len(data)
+    variance = np.ones(n_lags) / n_data
+    variance[2:] += 2 * np.cumsum(acf[1:-1]**2) / n_data
+    variance[:1] = 0
+    return acf, pacf, z * np.sqrt(variance), z / np.sqrt(n_data)
 
 
 def harmonic(data, n_harmonics):
@@ -305,36 +808,44 @@ def harmonic(data, n_harmonics):
         raise ValueError('Too many harmonics, maximum number of harmonics is \
                         {0}'.format(int(len(data)/2)))
     
+    data = np.asarray(data, dtype=float)
     data = data - np.mean(data)
-    fft_vec = np.fft.fft(data)
+    n_data = len(data)
+
+    # The input is real, so the spectrum is hermitian: only compute the
+    # non-negative frequencies and mirror them to get the full spectrum.
+    rfft_vec = np.fft.rfft(data)
+    fft_vec = np.empty(n_data, dtype=complex)
+    fft_vec[:len(rfft_vec)] = rfft_vec
+    fft_vec[len(rfft_vec):] = np.conj(rfft_vec[1:n_data - len(rfft_vec) + 1]
+                                      [::-1])
     ps = np.abs(fft_vec)**2
-    
-    # get the value of the nth harmonic
-    ps_lim = np.sort(ps)[-n_harmonics*2]
-    
-    # Turn everything below that harmonic equal to 0
-    clean_fft_vec = np.array([fft_vec[i] if ps[i] >= ps_lim else 0 for i in range(len(fft_vec))])
 
-    # Do the inverse fft
-    trend = np.real(np.fft.ifft(clean_fft_vec))
+    # get the value of the nth harmonic (the n_harmonics*2-th largest power,
+    # or the smallest power when no harmonics are requested)
+    kth = n_data - n_harmonics*2 if n_harmonics else 0
+    ps_lim = np.partition(ps, kth)[kth]
+
+    # Turn everything below that harmonic equal to 0 and do the inverse fft
+    keep = ps[:len(rfft_vec)] >= ps_lim
+    trend = np.fft.irfft(np.where(keep, rfft_vec, 0), n_data)
 
     #get the parameters
-    a_param = np.array([np.real(fft_vec[i]) for i in range(len(fft_vec)) if ps[i] <= ps_lim ])
-    b_param = np.array([np.imag(fft_vec[i]) for i in range(len(fft_vec)) if ps[i] <= ps_lim ])
-    sigma_param = np.array([np.abs(fft_vec[i])**2 for i in range(len(fft_vec)) if ps[i] <= ps_lim ])
-    
+    below = ps <= ps_lim
+    a_param = fft_vec.real[below]
+    b_param = fft_vec.imag[below]
+    sigma_param = ps[below]
+
     # get the accumulated ps for half the ps
-    ps = ps[:int(len(ps)/2)]
-    ps = np.sort(ps)[::-1]
-    ac_ps = np.cumsum(ps/np.max(np.cumsum(ps)))
-    
+    ps = np.sort(ps[:int(n_data/2)])[::-1]
+    ac_ps = np.cumsum(ps/np.sum(ps))
+
     # get detrended serie
     det_serie = data - trend
     param = a_param, b_param, sigma_param
-    
-    det_serie = np.array(det_serie)
-    x_ac_ps = len(ac_ps)/np.array(range(1, len(ac_ps) + 1))
-    
+
+    x_ac_ps = len(ac_ps)/np.arange(1, len(ac_ps) + 1)
+
     return det_serie, trend, param, ac_ps, x_ac_ps
 
 
@@ -375,22 +886,384 @@ def autoregressive(data, per):
         raise ValueError('Too many periods, maximum number of periods is '
                          '{0}'.format(int(0.3*len(data))))
                         
-    ar_model = sts.tsa.AR(data).fit(per)
-    aic_model = ar_model.aic
-    std_error = np.sqrt(ar_model.sigma2)
-    
-    #Model Run
+    data = np.asarray(data, dtype=float)
+    params, sigma2, aic = autoregressive_orders(data, per)
+    param = params[per, :per + 1]
+    aic_model = aic[per]
+    std_error = np.sqrt(sigma2[per])
+
+    #Model Run, one step ahead predictions after the first per values
     trend = np.zeros(len(data))
-    trend[:per-1] = np.average(data)
-    trend[per-1:] = ar_model.predict(per,len(data))
-    
+    trend[:per] = np.average(data)
+    trend[per:] = param[0]
+    for lag in range(1, per + 1):
+        trend[per:] += param[lag] * data[per - lag:len(data) - lag]
+
     #Detrended serie
-    det_serie = data - trend    
+    det_serie = data - trend
+
+    return det_serie, trend, param, aic_model, std_error
+
+
+def autoregressive_orders(data, max_order):
+    '''
+    Fits the autoregressive models of order 0 to max_order at once
     
-    #Parameter vector
-    param = ar_model.params
+    The Yule-Walker equations of all orders are solved in a single
+    Levinson-Durbin recursion on the autocovariances of the series.
     
-    return det_serie, trend, param, aic_model, std_error
+    Parameters
+    ----------
+    data : array_like
+        Time series, or a 2d array with a time series per row
+    max_order : int
+        Highest order of the autoregressive models
+    
+    Returns
+    -------
+    params : nd_array
+        Parameters of every order, row p holds the constant followed by the
+        p coefficients of the model of order p (zero padded)
+    sigma2 : nd_array
+        Variance of the innovation (error) term of every order
+    aic : nd_array
+        Akaike Information Criterion of every order, the order with the
+        smallest value is the suggested order
+
+    Notes
+    -----
+    The AIC of the Yule-Walker fit of order p is
+    log(sigma2) + 2 * (p + 1) / n, with sigma2 the innovation variance of
+    the whole series and p + 1 parameters (the coefficients and the
+    constant) for all n values.
+    '''
+    data = np.asarray(data, dtype=float)
+    rows = data if data.ndim == 2 else data[None, :]
+    n_data = rows.shape[1]
+    if not isinstance(max_order, int) or max_order < 0:
+        raise ValueError('max_order has to be a positive integer')
+    if max_order >= n_data - 1:
+        raise ValueError('Too many periods, maximum number of periods is '
+                         '{0}'.format(n_data - 2))
+
+    mean = rows.mean(axis=1)
+    variance = ((rows - mean[:, None])**2).mean(axis=1)
+    acf = _autocorrelation_rows(rows, max_order + 1, windowed=False)
+    phi, _, sigma = _levinson_durbin(acf, max_order)
+    sigma2 = sigma * variance[:, None]
+    params = np.zeros((len(rows), max_order + 1, max_order + 1))
+    params[:, :, 1:] = phi
+    params[:, :, 0] = mean[:, None] * (1 - phi.sum(axis=2))
+    orders = np.arange(max_order + 1)
+    aic = np.log(sigma2) + 2 * (orders + 1) / n_data
+    if data.ndim != 2:
+        return params[0], sigma2[0], aic[0]
+    return params, sigma2, aic
+
+
+TREND_TYPES = ('linear', 'step', 'both', 'none')
+
+
+def batch(data, trend='linear', bp=0, alpha=0.05, n_harmonics=3, n_lags=2,
+          per=2, frequency='M'):
+    """
+    Runs the complete FREQ chain (trend, harmonic, correlogram and
+    autoregressive model) over many time series at once.
+
+    Series of equal length are stacked and analysed with vectorized numpy
+    operations, mirroring the single series functions in this module.
+
+    Parameters
+    ----------
+    data : array_like or dict
+        2-D array with one (already loaded) series per row, or a dict of
+        series. Values that are pd Series are loaded (resampled and
+        interpolated) first, other values are used as is.
+    trend : str
+        One of 'linear', 'step', 'both' (step followed by linear) or 'none'
+    bp : int or array_like
+        Breaking point of the step trend, either one for all series or one
+        per series.
+    alpha : float
+        significance of the t-tests (0-1)
+    n_harmonics : int
+        Number of harmonics to be removed from the series
+    n_lags : int
+        Number of lags used for the correlogram computation
+    per : int
+        Order of the autoregressive model
+    frequency : str
+        Frequency used to load pd Series
+
+    Returns
+    -------
+    table : pd DataFrame
+        One row per series (indexed by the dict keys or row numbers) with the
+        trend parameters, p-values and significance at alpha, the harmonic
+        residual sigma, the correlogram and the autoregressive parameters,
+        AIC and sigma. Series shorter than MIN_SAMPLES, or too short for
+        their breaking point, n_harmonics, n_lags or per, get a row of NaN.
+    """
+    if alpha > 1.0 or alpha < 0.0:
+        raise ValueError('Alpha value has to be between 0 and 1')
+    if trend not in TREND_TYPES:
+        raise ValueError('trend has to be one of {0}'.format(TREND_TYPES))
+    if not isinstance(n_harmonics, int) or n_harmonics < 0:
+        raise ValueError('n_harmonics has to be a positive integer')
+    if not isinstance(n_lags, int) or n_lags < 0:
+        raise ValueError('n_lags has to be a positive integer')
+    if not isinstance(per, int) or per < 0:
+        raise ValueError('per has to be a positive integer')
+    if np.any(np.asarray(bp) < 0):
+        raise ValueError('The breaking point has to be positive')
+
+    if isinstance(data, dict):
+        keys = list(data.keys())
+        series = [data[key] for key in keys]
+    else:
+        series = np.atleast_2d(np.asarray(data, dtype=float))
+        keys = list(range(len(series)))
+    series = [load(data=s, frequency=frequency)[1]
+              if isinstance(s, pd.Series) else np.asarray(s, dtype=float)
+              for s in series]
+    bps = np.broadcast_to(np.asarray(bp, dtype=int), (len(series), ))
+
+    lengths = np.array([len(s) for s in series], dtype=int)
+    tables = []
+    for length in np.unique(lengths):
+        members = np.flatnonzero(lengths == length)
+        if length < MIN_SAMPLES or n_harmonics > length / 2 or \
+                n_lags >= length or per > 0.3 * length:
+            logger.debug('Skipping %d series with only %d samples',
+                         len(members), length)
+            continue
+        # series shorter than their breaking point are skipped too
+        members = members[bps[members] <= length]
+        if not len(members):
+            continue
+        group = np.vstack([series[i] for i in members])
+        tables.append(pd.DataFrame(
+            _batch_rows(group, trend, bps[members], alpha, n_harmonics, n_lags,
+                        per),
+            index=members
+        ))
+    columns = _batch_columns(trend, n_lags, per)
+    if tables:
+        table = pd.concat(tables).reindex(index=range(len(series)),
+                                          columns=columns)
+    else:
+        table = pd.DataFrame(np.nan, index=range(len(series)),
+                             columns=columns)
+    table.index = keys
+    return table
+
+
+def _batch_columns(trend, n_lags, per):
+    """
+    Names of the result columns of _batch_rows.
+    """
+    step = ['step_' + name for name in
+            ('mean_a', 'mean_b', 'pval', 't', 'significant')]
+    linear = ['linear_' + name for name in
+              ('a', 'b', 'r', 'pval', 't', 'significant')]
+    columns = {'step': step, 'none': step, 'linear': linear,
+               'both': step + linear}[trend]
+    return (columns + ['harmonic_sigma'] +
+            ['correlogram_{0}'.format(lag) for lag in range(n_lags)] +
+            ['ar_{0}'.format(i) for i in range(per + 1)] + ['aic', 'sigma'])
+
+
+def _batch_rows(data, trend, bp, alpha, n_harmonics, n_lags, per):
+    """
+    Runs the FREQ chain over the rows of a 2-D array of equal length series.
+
+    Returns an OrderedDict of result columns, see _batch_columns. The
+    parameters are checked by batch.
+    """
+    columns = OrderedDict()
+    det_serie = data
+    if trend in ('step', 'none'):
+        det_serie, param = _step_rows(det_serie, bp if trend == 'step' else
+                                      np.zeros_like(bp))
+    elif trend == 'both':
+        det_serie, param = _step_rows(det_serie, bp)
+        for name, column in zip(('mean_a', 'mean_b', 'pval', 't'), param):
+            columns['step_' + name] = column
+        columns['step_significant'] = (param[2] >= 0) & (param[2] < alpha)
+        det_serie, param = _linear_rows(det_serie)
+    else:
+        det_serie, param = _linear_rows(det_serie)
+    names = ('a', 'b', 'r', 'pval', 't') if trend in ('linear', 'both') \
+        else ('mean_a', 'mean_b', 'pval', 't')
+    prefix = 'linear_' if trend in ('linear', 'both') else 'step_'
+    for name, column in zip(names, param):
+        columns[prefix + name] = column
+    pval = param[-2]
+    columns[prefix + 'significant'] = (pval >= 0) & (pval < alpha)
+
+    harmonic_serie = _harmonic_rows(det_serie, n_harmonics)
+    columns['harmonic_sigma'] = np.std(harmonic_serie, axis=1)
+
+    for lag, column in enumerate(_correlogram_rows(det_serie, n_lags).T):
+        columns['correlogram_{0}'.format(lag)] = column
+
+    params, aic, std_error = _autoregressive_rows(harmonic_serie, per)
+    for i, column in enumerate(params.T):
+        columns['ar_{0}'.format(i)] = column
+    columns['aic'] = aic
+    columns['sigma'] = std_error
+    return columns
+
+
+def _step_rows(data, bp):
+    """
+    Vectorized step: detrends the rows of data at breaking points bp.
+
+    Rows with a breaking point of zero are only centered, like step does.
+    """
+    n_data = data.shape[1]
+    before = np.arange(n_data) < bp[:, None]
+    n_a = bp.astype(float)
+    n_b = n_data - n_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_a = np.where(before, data, 0).sum(axis=1) / n_a
+        mean_b = np.where(before, 0, data).sum(axis=1) / n_b
+        trend = np.where(before, mean_a[:, None], mean_b[:, None])
+        det_serie = data - trend
+
+        # pooled variance two sided t-test, as scipy.stats.ttest_ind
+        dof = n_data - 2
+        pooled_var = (det_serie**2).sum(axis=1) / dof
+        t_test_val = (mean_a - mean_b) / np.sqrt(
+            pooled_var * (1.0 / n_a + 1.0 / n_b))
+        pval = 2 * st.t.sf(np.abs(t_test_val), dof)
+    no_trend = bp == 0
+    mean_a[no_trend] = mean_b[no_trend]
+    t_test_val[no_trend] = ERROR_CODE
+    pval[no_trend] = ERROR_CODE
+    return det_serie, (mean_a, mean_b, pval, t_test_val)
+
+
+def _linear_rows(data):
+    """
+    Vectorized linear: removes the least squares linear trend of each row.
+    """
+    x_values = np.arange(data.shape[1], dtype=float)
+    x_anom = x_values - x_values.mean()
+    y_anom = data - data.mean(axis=1)[:, None]
+    ss_x = (x_anom**2).sum()
+    ss_y = (y_anom**2).sum(axis=1)
+    s_xy = (y_anom * x_anom).sum(axis=1)
+    a = s_xy / ss_x
+    b = data.mean(axis=1) - a * x_values.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = s_xy / np.sqrt(ss_x * ss_y)
+    trend = a[:, None] * x_values + b[:, None]
+    det_serie = data - trend
+    t_test_val, pval = st.ttest_ind(det_serie, data, axis=1)
+    return det_serie, (a, b, r, pval, t_test_val)
+
+
+def _harmonic_rows(data, n_harmonics):
+    """
+    Vectorized harmonic: removes the n_harmonics strongest harmonics of each
+    row and returns the detrended rows.
+    """
+    n_data = data.shape[1]
+    data = data - data.mean(axis=1)[:, None]
+    rfft_vec = np.fft.rfft(data, axis=1)
+    n_rfft = rfft_vec.shape[1]
+    ps_half = np.abs(rfft_vec)**2
+    ps = np.hstack((ps_half, ps_half[:, 1:n_data - n_rfft + 1][:, ::-1]))
+    kth = n_data - n_harmonics*2 if n_harmonics else 0
+    ps_lim = np.partition(ps, kth, axis=1)[:, kth]
+    keep = ps_half >= ps_lim[:, None]
+    trend = np.fft.irfft(np.where(keep, rfft_vec, 0), n_data, axis=1)
+    return data - trend
+
+
+def _correlogram_rows(data, n_lags):
+    """
+    Vectorized correlogram of each row, as computed by correlogram.
+    """
+    return _autocorrelation_rows(data, n_lags, windowed=True)
+
+
+def _autocorrelation_rows(data, n_lags, windowed):
+    """
+    Autocorrelation of the lags 0 to n_lags - 1 of each row.
+
+    The lagged products are computed at once as a cross-correlation with
+    FFTs, O(n log n) for any number of lags, and the sums of the windows
+    with cumulative sums. The windowed estimator correlates the first
+    n - n_lags + 1 values with the values shifted by the lag, each window
+    with its own mean and variance.
+    """
+    # centred first, the correlations are the same and the sums smaller
+    data = data - data.mean(axis=1)[:, None]
+    n_data = data.shape[1]
+    n_window = n_data - n_lags + 1 if windowed else n_data
+    n_fft = 1 << (n_data + n_window).bit_length()
+    spectrum = np.fft.rfft(data, n_fft, axis=1)
+    if n_window < n_data:
+        first = np.fft.rfft(data[:, :n_window], n_fft, axis=1)
+    else:
+        first = spectrum
+    lagged = np.fft.irfft(np.conj(first) * spectrum, n_fft,
+                          axis=1)[:, :n_lags]
+    if not windowed:
+        return lagged / lagged[:, :1]
+    zero = np.zeros((len(data), 1))
+    cumsum = np.hstack((zero, np.cumsum(data, axis=1)))
+    cumsum_sq = np.hstack((zero, np.cumsum(data**2, axis=1)))
+    window_sum = cumsum[:, n_window:n_window + n_lags] - cumsum[:, :n_lags]
+    window_sq = cumsum_sq[:, n_window:n_window + n_lags] - \
+        cumsum_sq[:, :n_lags]
+    mean = window_sum / n_window
+    covariance = lagged - n_window * mean[:, :1] * mean
+    variance = window_sq - n_window * mean**2
+    return covariance / np.sqrt(variance[:, :1] * variance)
+
+
+def _levinson_durbin(acf, order):
+    """
+    Solves the Yule-Walker equations of the autoregressive models of order
+    0 to order with the Levinson-Durbin recursion, for every row of acf
+    (autocovariances or autocorrelations of the lags 0 to order).
+
+    Returns the coefficients of all orders (row p of the last two axes holds
+    the p coefficients of the model of order p), the partial
+    autocorrelations (the last coefficient of every order, 1 for order 0)
+    and the variance of the innovation term of every order.
+    """
+    acf = np.asarray(acf, dtype=float)
+    shape = acf.shape[:-1]
+    phi = np.zeros(shape + (order + 1, order))
+    pacf = np.ones(shape + (order + 1,))
+    sigma = np.empty(shape + (order + 1,))
+    sigma[..., 0] = acf[..., 0]
+    for k in range(1, order + 1):
+        previous = phi[..., k - 1, :k - 1]
+        reflection = (acf[..., k] - (
+            previous * acf[..., k - 1:0:-1]).sum(axis=-1)) / sigma[..., k - 1]
+        phi[..., k, :k - 1] = previous - reflection[..., None] * \
+            previous[..., ::-1]
+        phi[..., k, k - 1] = reflection
+        pacf[..., k] = reflection
+        sigma[..., k] = sigma[..., k - 1] * (1 - reflection**2)
+    return phi, pacf, sigma
+
+
+def _autoregressive_rows(data, per):
+    """
+    Vectorized Yule-Walker fit of an AR(per) model with a constant to each
+    row, as autoregressive.
+
+    Returns the parameters (constant first), the AIC and the standard
+    deviation of the innovation term of each row.
+    """
+    params, sigma2, aic = autoregressive_orders(data, per)
+    return params[:, per, :per + 1], aic[:, per], np.sqrt(sigma2[:, per])
 
 
 def test():
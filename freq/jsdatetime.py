@@ -6,6 +6,8 @@ Collection of functions that transform
 
 import datetime as dt
 
+import numpy as np
+
 
 JS_EPOCH = dt.datetime(1970, 1, 1)
 
@@ -21,6 +23,13 @@ def now_iso():
     return dt.datetime.now().isoformat().split('.')[0] + 'Z'
 
 
+def now_js():
+    """
+    The js timestamp of the moment now is called, like now_iso.
+    """
+    return datetime_to_js(dt.datetime.now())
+
+
 def round_js_to_date(js_datetime):
     date_time = js_to_datetime(js_datetime)
     round_datetime = dt.datetime.combine(date_time.date(),
@@ -38,11 +47,49 @@ def js_to_datetime(date_time):
         return JS_EPOCH + dt.timedelta(seconds=date_time/1000)
 
 
+def js_to_datetime64(js_dates, unit='D'):
+    """
+    Array version of js_to_datetime.
+    :param js_dates: array_like of js timestamps (milliseconds since epoch).
+    :param unit: numpy datetime unit the dates are floored to, defaults to
+                 days like js_to_datestring.
+    :return: datetime64 array.
+    """
+    js_dates = np.asarray(js_dates)
+    if js_dates.dtype.kind == 'f':
+        js_dates = np.floor(js_dates)
+    return js_dates.astype(np.int64).astype('datetime64[ms]').astype(
+        'datetime64[{}]'.format(unit))
+
+
+def datetime64_to_js(date_times):
+    """
+    Array version of datetime_to_js.
+    :param date_times: DatetimeIndex, datetime64 array or list of datetimes.
+    :return: int64 array of js timestamps (milliseconds since epoch).
+    """
+    return np.asarray(date_times, dtype='datetime64[ms]').astype(np.int64)
+
+
 def js_to_datestring(js_date, iso=False):
     date_time = js_to_datetime(js_date)
     return datetime_to_datestring(date_time, iso)
 
 
+def js_to_datestrings(js_dates, iso=False):
+    """
+    Array version of js_to_datestring.
+    :param js_dates: array_like of js timestamps (milliseconds since epoch).
+    :return: list of '%d-%m-%Y' (or with iso '%Y-%m-%d') date strings.
+    """
+    dates = np.datetime_as_string(js_to_datetime64(js_dates), unit='D')
+    if iso:
+        return dates.tolist()
+    # '%Y-%m-%d' to '%d-%m-%Y', years are four digits like with strftime
+    return [date[8:10] + '-' + date[5:7] + '-' + date[:4]
+            for date in dates.tolist()]
+
+
 def datetime_to_datestring(date_time, iso=False):
     if iso:
         return date_time.strftime('%Y-%m-%d')
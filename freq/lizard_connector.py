@@ -1,8 +1,11 @@
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import datetime as dt
 import json
 import logging
+import math
 from pprint import pprint  # left here for debugging purposes
+import tempfile
 from time import time
 from time import sleep
 import urllib
@@ -10,15 +13,19 @@ import urllib
 import numpy as np
 import django.core.exceptions
 
+from freq import event_stream
 from freq import jsdatetime
+from freq.transport import ConnectionPool
 try:
     from django.conf import settings
     USR, PWD = settings.USR, settings.PWD
+    CONNECTION_POOL = getattr(settings, 'LIZARD_CONNECTION_POOL', {})
 except django.core.exceptions.ImproperlyConfigured:
     print('WARNING: no USR and PWD found in settings. USR and PWD should have'
           'been set beforehand')
     USR = None
     PWD = None
+    CONNECTION_POOL = {}
 
 # When you use this script stand alone, please set your login information here:
 # USR = ******  # Replace the stars with your user name.
@@ -27,6 +34,14 @@ except django.core.exceptions.ImproperlyConfigured:
 
 logger = logging.getLogger(__name__)
 
+# Keep-alive connections shared by all api clients.
+TRANSPORT = ConnectionPool(**CONNECTION_POOL)
+
+
+# Records of the events of a csv task result, spooled to a temporary file.
+SPOOL_DTYPE = np.dtype([('index', np.int64), ('timestamp', np.int64),
+                        ('value', np.float64)])
+
 
 def join_urls(*args):
     return '/'.join(args)
@@ -47,10 +62,20 @@ class Base(object):
     :param extra_queries: In case one wishes to set default queries for a
                           certain data type this is the plase.
     :param max_results:
+    :param max_concurrent_pages: maximum number of pages fetched at the same
+                                 time when a response spans multiple pages.
+    :param transport: the connection pool used for all requests.
+    :param events_field: when set, the events of responses are decoded while
+                         they are downloaded, into (timestamps, values) numpy
+                         arrays in the events attribute. The events field is
+                         used as value, the events in json are left empty.
     """
     username = USR
     password = PWD
     max_results = 1000
+    max_concurrent_pages = 4
+    transport = TRANSPORT
+    events_field = None
 
     @property
     def extra_queries(self):
@@ -86,6 +111,7 @@ class Base(object):
         self.use_header = use_header
         self.queries = {}
         self.results = []
+        self.events = []
         if base.startswith('http'):
             self.base = base
         else:
@@ -101,6 +127,42 @@ class Base(object):
         :param queries: all keyword arguments are used as queries.
         :return: a dictionary of the api-response.
         """
+        url = self.query_url(uuid, **queries)
+        self.json, events = self.request_query(url)
+        self.events += events
+        self.parse()
+        return self.results
+
+    def request_query(self, url):
+        """
+        GETs the first page of a query. Unlike fetch the response is not
+        stored, so this can run in an executor.
+        :param url: full query url
+        :return: the JSON from the response and the list of its events (empty
+                 without events_field), an empty result when the request
+                 failed.
+        """
+        try:
+            if self.events_field:
+                content, events = self.request_events(url)
+            else:
+                content, events = self.request_json(url), []
+        except urllib.error.HTTPError:  # TODO remove hack to prevent 420 error
+            content, events = {'results': [], 'count': 0}, []
+        try:
+            logger.debug('Number found %s : %s with URL: %s', self.data_type,
+                         content.get('count', 0), url)
+        except (KeyError, AttributeError):
+            logger.debug('Got results from %s with URL: %s',
+                         self.data_type, url)
+        return content, events
+
+    def query_url(self, uuid=None, **queries):
+        """
+        :param uuid: uuid of a single object, queries are then ignored.
+        :param queries: all keyword arguments are used as queries.
+        :return: the url of a query with the default and extra queries.
+        """
         if self.max_results:
             queries.update({'page_size': self.max_results, 'format': 'json'})
         queries.update(self.extra_queries)
@@ -109,20 +171,8 @@ class Base(object):
                                (('&' + str(key) + '=').join(value)
                                if isinstance(value, list) else str(value))
                                for key, value in queries.items())
-        url = urllib.parse.urljoin(self.base_url, str(uuid)) if uuid else \
+        return urllib.parse.urljoin(self.base_url, str(uuid)) if uuid else \
             self.base_url + query
-        try:
-            self.fetch(url)
-        except urllib.error.HTTPError:  # TODO remove hack to prevent 420 error
-            self.json = {'results': [], 'count': 0}
-        try:
-            logger.debug('Number found %s : %s with URL: %s', self.data_type,
-                         self.json.get('count', 0), url)
-        except (KeyError, AttributeError):
-            logger.debug('Got results from %s with URL: %s',
-                         self.data_type, url)
-        self.parse()
-        return self.results
 
     def fetch(self, url):
         """
@@ -132,21 +182,48 @@ class Base(object):
                     [base_url]/api/v2/[endpoint]/?[query_key]=[query_value]&...
         :return: the JSON from the response
         """
-        if self.use_header:
-            request_obj = urllib.request.Request(url, headers=self.header)
+        if self.events_field:
+            self.json, events = self.request_events(url)
+            self.events += events
         else:
-            request_obj = urllib.request.Request(url)
+            self.json = self.request_json(url)
+        return self.json
+
+    def request_events(self, url):
+        """
+        GETs an url and decodes the events of the JSON response while it is
+        downloaded.
+        :param url: full query url
+        :return: the JSON from the response with empty events and a list of
+                 (timestamps, values) arrays, one for every events list.
+        """
         try:
-            with urllib.request.urlopen(request_obj) as resp:
+            with self.transport.urlopen(url, headers=self.header) as resp:
                 encoding = resp.headers.get_content_charset()
                 encoding = encoding if encoding else 'UTF-8'
-                content = resp.read().decode(encoding)
-                self.json = json.loads(content)
+                return event_stream.decode_events(
+                    resp, value_field=self.events_field, encoding=encoding)
         except Exception:
             logger.exception("got error from: %s", url)
             raise
 
-        return self.json
+    def request_json(self, url):
+        """
+        GETs parameters from the api based on an url in a JSON format.
+        Unlike fetch the response is not stored, so this can be used from
+        multiple threads at once.
+        :param url: full query url
+        :return: the JSON from the response
+        """
+        try:
+            with self.transport.urlopen(url, headers=self.header) as resp:
+                encoding = resp.headers.get_content_charset()
+                encoding = encoding if encoding else 'UTF-8'
+                content = resp.read().decode(encoding)
+                return json.loads(content)
+        except Exception:
+            logger.exception("got error from: %s", url)
+            raise
 
     def parse(self):
         """
@@ -163,16 +240,65 @@ class Base(object):
                     )
                 self.results += self.json['results']
                 next_url = self.json.get('next')
-                if next_url:
-                    self.fetch(next_url)
-                else:
+                if not next_url:
                     break
+                page_urls = None if self.events_field else \
+                    self.page_urls(next_url)
+                if page_urls:
+                    for page in self.fetch_pages(page_urls):
+                        self.results += page['results']
+                    break
+                self.fetch(next_url)
             except KeyError:
                 self.results += [self.json]
                 break
             except IndexError:
                 break
 
+    def page_urls(self, next_url):
+        """
+        Urls of all remaining pages, computed from the count and the size of
+        the current page and the next url.
+        Supports page number and limit/offset pagination.
+        :return: list of urls or None when they can not be computed.
+        """
+        page_size = len(self.json['results'])
+        if not page_size:
+            return
+        n_pages = int(math.ceil(self.json['count'] / page_size))
+        scheme, netloc, path, query, fragment = urllib.parse.urlsplit(
+            next_url)
+        query = urllib.parse.parse_qsl(query, keep_blank_values=True)
+        keys = [key for key, _ in query]
+        if 'page' in keys:
+            pages = [('page', page) for page in range(2, n_pages + 1)]
+        elif 'offset' in keys:
+            pages = [('offset', page * page_size) for page in
+                     range(1, n_pages)]
+        else:
+            return
+        return [
+            urllib.parse.urlunsplit((
+                scheme, netloc, path,
+                urllib.parse.urlencode([
+                    (key, value if key != page_key else page_value)
+                    for key, value in query
+                ]),
+                fragment
+            ))
+            for page_key, page_value in pages
+        ]
+
+    def fetch_pages(self, urls):
+        """
+        GETs the JSON of multiple urls concurrently, with at most
+        max_concurrent_pages requests in flight.
+        :return: list of the JSON responses in the order of urls.
+        """
+        workers = max(1, min(self.max_concurrent_pages, len(urls)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.request_json, urls))
+
     def parse_elements(self, element):
         """
         Get a list of a certain element from the root of the results attribute.
@@ -238,7 +364,7 @@ class Locations(Base):
         max_lat, max_lon = north_east
         coords = self.commaify(min_lon, min_lat, max_lon, max_lat)
         org_query = self.organisation_query(organisation, '')
-        self.get(in_bbox=coords, **org_query)
+        return self.get(in_bbox=coords, **org_query)
 
     def distance_to_point(self, distance, lat, lon, organisation=None):
         """
@@ -300,19 +426,30 @@ class TaskAPI(Base):
             return "NONE"
 
     def timeseries_csv(self, organisation, extra_queries_ts):
+        """
+        Downloads the result of a csv task, see timeseries_header.
+        :return: iterables of the header rows (one per timeseries) and of the
+                 event rows.
+        """
+        return self.timeseries_header(organisation, extra_queries_ts), \
+            self.csv_rows()
+
+    def timeseries_header(self, organisation, extra_queries_ts,
+                          progress=None):
+        """
+        Downloads the result of a csv task.
+        The events are streamed from the result url into a temporary file,
+        only the metadata of the timeseries is kept in memory, in the results
+        attribute.
+        :param progress: function called after every spooled batch of events.
+        :return: iterable of the [uuid, name, location_name, x, y] header
+                 rows, one per timeseries.
+        """
         if self.status != "SUCCESS":
             raise LizardApiError('Download not ready.')
-        url = self.json.get("result_url")
-        self.fetch(url)
-        self.results = []
-        self.parse()
+        self.spool_events(self.json.get("result_url"), progress)
 
-        csv = (
-            [result['name'], result['uuid'],
-             jsdatetime.js_to_datestring(event['timestamp']), event['max']]
-            for result in self.results for event in result['events']
-        )
-        loc = Locations(use_header=self.use_header)
+        loc = Locations(self.base, use_header=self.use_header)
         extra_queries = {
             key if not key.startswith("location__") else key[10:]: value
             for key, value in extra_queries_ts.items()
@@ -329,13 +466,106 @@ class TaskAPI(Base):
             ]
             for r in self.results
         )
-        return headers, csv
+        return headers
+
+    def spool_events(self, url, progress=None):
+        """
+        Streams the events of all pages of a task result into a temporary
+        file of (timeseries number, timestamp, value) records and their
+        timeseries without events into the results attribute.
+        :param progress: function called after every spooled batch of events.
+        """
+        self.results = []
+        self.spool = tempfile.TemporaryFile()
+        while url:
+            with self.transport.urlopen(url, headers=self.header) as resp:
+                encoding = resp.headers.get_content_charset()
+                events = event_stream.EventStream(
+                    resp, value_field='max',
+                    encoding=encoding if encoding else 'UTF-8')
+                for index, timestamps, values in events:
+                    records = np.empty(len(timestamps), dtype=SPOOL_DTYPE)
+                    records['index'] = index + len(self.results)
+                    records['timestamp'] = timestamps
+                    records['value'] = np.array(values, dtype=np.float64)
+                    records.tofile(self.spool)
+                    if progress is not None:
+                        progress()
+            document = events.document
+            if isinstance(document, dict) and 'results' in document:
+                results = document['results']
+                url = document.get('next')
+            else:
+                results = document if isinstance(document, list) \
+                    else [document]
+                url = None
+            with_events = [r for r in results if 'events' in r]
+            if len(with_events) != events.n_arrays:
+                raise LizardApiError('Unexpected events in task result.')
+            self.results += with_events
+        self.spool.flush()
+
+    def spooled_events(self, block_size=2**16):
+        """
+        Reads the spooled events back per block.
+        :return: iterator of record arrays with index, timestamp and value.
+        """
+        self.spool.seek(0)
+        while True:
+            records = np.fromfile(self.spool, dtype=SPOOL_DTYPE,
+                                  count=block_size)
+            if not len(records):
+                break
+            yield records
+
+    def timeseries_events(self):
+        """
+        :return: iterator of (uuid, timestamps, values) of the spooled
+                 timeseries.
+        """
+        empty = np.empty(0, dtype=SPOOL_DTYPE)
+        parts = [empty]
+        index = 0
+        for records in self.spooled_events():
+            bounds = np.flatnonzero(np.diff(records['index'])) + 1
+            for part in np.split(records, bounds):
+                while index < part['index'][0]:
+                    events = np.concatenate(parts)
+                    yield (self.results[index]['uuid'], events['timestamp'],
+                           events['value'])
+                    parts = [empty]
+                    index += 1
+                parts.append(part)
+        while index < len(self.results):
+            events = np.concatenate(parts)
+            yield (self.results[index]['uuid'], events['timestamp'],
+                   events['value'])
+            parts = [empty]
+            index += 1
+
+    def csv_rows(self):
+        """
+        :return: iterator of the (name, uuid, date, value) event rows, with
+                 '%d-%m-%Y' dates.
+        """
+        names = [(r['name'], r['uuid']) for r in self.results]
+        for records in self.spooled_events():
+            dates = jsdatetime.js_to_datestrings(records['timestamp'])
+            values = records['value'].astype(object)
+            values[np.isnan(records['value'])] = None
+            for index, date, value in zip(records['index'].tolist(),
+                                          dates, values.tolist()):
+                name, uuid = names[index]
+                yield [name, uuid, date, value]
 
 
 class TimeSeries(Base):
     """
     Makes a connection to the timeseries endpoint of the lizard api.
+    :param max_concurrent_timeseries: maximum number of timeseries downloaded
+                                      at the same time by location_uuid.
     """
+    max_concurrent_timeseries = 4
 
     def __init__(self, base="https://ggmn.lizard.net", use_header=False):
         self.data_type = 'timeseries'
@@ -354,42 +584,63 @@ class TimeSeries(Base):
         return self.get(location__name=name, **org_query)
 
     def location_uuid(self, loc_uuid, start='0001-01-01T00:00:00Z', end=None,
-                      organisation=None):
+                      organisation=None, metadata_only=False):
         """
         Returns time series for a location by location-UUID.
+        The timeseries of the location are downloaded concurrently, with at
+        most max_concurrent_timeseries downloads at the same time.
         :param loc_uuid: name of a location
         :param start: start timestamp in ISO 8601 format
         :param end: end timestamp in ISO 8601 format, defaults to now
+        :param metadata_only: when True only the metadata of the timeseries
+                              is returned and their events are not
+                              downloaded.
         :return: a dictionary of with nested location, aquo quantities and
                  events.
         """
         org_query = self.organisation_query(organisation)
         self.get(location__uuid=loc_uuid, **org_query)
+        if metadata_only:
+            return self.results
         timeseries_uuids = [x['uuid'] for x in self.results]
         self.results = []
-        for ts_uuid in timeseries_uuids:
+        if not timeseries_uuids:
+            return self.results
+
+        def download(ts_uuid):
             ts = TimeSeries(self.base, use_header=self.use_header)
             ts.uuid(ts_uuid, start, end, organisation)
-            self.results += ts.results
+            return ts.results
+
+        workers = min(self.max_concurrent_timeseries, len(timeseries_uuids))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for results in executor.map(download, timeseries_uuids):
+                self.results += results
         return self.results
 
     def uuid(self, ts_uuid, start='0001-01-01T00:00:00Z', end=None,
-             organisation=None):
+             organisation=None, events_field=None):
         """
         Returns time series for a timeseries by timeseries-UUID.
         :param ts_uuid: uuid of a timeseries
         :param start: start timestamp in ISO 8601 format
         :param end: end timestamp in ISO 8601 format
+        :param events_field: when given, the events are streamed into numpy
+                             arrays of this field in the events attribute
+                             instead of being stored in the results.
         :return: a dictionary of with nested location, aquo quantities and
                  events.
         """
+        if events_field:
+            self.events_field = events_field
         if not end:
             end = jsdatetime.now_iso()
         old_base_url = self.base_url
         self.base_url += ts_uuid + "/"
         org_query = self.organisation_query(organisation)
-        self.get(start=start, end=end, **org_query)
+        results = self.get(start=start, end=end, **org_query)
         self.base_url = old_base_url
+        return results
 
     def start_csv_task(self, start='0001-01-01T00:00:00Z', end=None,
                organisation=None):
@@ -400,10 +651,11 @@ class TimeSeries(Base):
         if isinstance(end, int):
             end += 10000
         org_query = self.organisation_query(organisation)
+        # async is a reserved keyword since python 3.7
+        org_query['async'] = "true"
         poll_url = self.get(
             start=start,
             end=end,
-            async="true",
             format="json",
             **org_query
         )[0]['url']
@@ -423,6 +675,25 @@ class TimeSeries(Base):
         :param end: end timestamp in ISO 8601 format
         :return: a dictionary of the api-response.
         """
+        queries = self.bbox_queries(south_west, north_east, statistic, start,
+                                    end, organisation)
+        if len(queries) == 1:
+            return self.get(**queries[0])
+        first_year = self.get(**queries[0])
+        self.results = []
+        self.get(**queries[1])
+        self.combine_years(first_year)
+
+    def bbox_queries(self, south_west, north_east, statistic=None,
+                     start='0001-01-01T00:00:00Z', end=None,
+                     organisation=None):
+        """
+        Queries of bbox, sets the statistic attribute.
+        :return: a list with the queries of a request. For the difference
+                 (mean last - first year) the list holds the queries of the
+                 first and of the last year, to be combined with
+                 combine_years.
+        """
         if not end:
             end = jsdatetime.now_iso()
         if isinstance(start, int):
@@ -458,58 +729,71 @@ class TimeSeries(Base):
             year = dt.timedelta(days=366)
             first_end = jsdatetime.datetime_to_js(jsdatetime.js_to_datetime(start) + year)
             last_start = jsdatetime.datetime_to_js(jsdatetime.js_to_datetime(end) - year)
-            self.get(
-                start=start,
-                end=first_end,
-                min_points=1,
-                fields=['count', 'sum'],
-                location__geom_within=geom_within,
-                **org_query
-            )
-            first_year = {}
-            for r in self.results:
-                try:
-                    first_year[r['location']['uuid']] = {
-                      'first_value_timestamp': r['first_value_timestamp'],
-                      'mean': r['events'][0]['sum'] / r['events'][0]['count']
-                    }
-                except IndexError:
-                    first_year[r['location']['uuid']] = {
-                      'first_value_timestamp': np.nan,
-                      'mean': np.nan
-                    }
-            self.results = []
-            self.get(
-                start=last_start,
-                end=end,
-                min_points=1,
-                fields=['count', 'sum'],
-                location__geom_within=geom_within,
-                **org_query
-            )
-            for r in self.results:
-                try:
-                    r['events'][0]['difference (mean last - first year)'] = \
-                        r['events'][0]['sum'] / r['events'][0]['count'] - \
-                        first_year[r['location']['uuid']]['mean']
-                    r['first_value_timestamp'] = \
-                        first_year[
-                            r['location']['uuid']]['first_value_timestamp']
-                except IndexError:
-                    r['events'] = [{
-                        'difference (mean last - first year)': np.nan}]
-                    r['first_value_timestamp'] = np.nan
-                    r['last_value_timestamp'] = np.nan
-            return
+            return [
+                dict(start=start, end=first_end, min_points=1,
+                     fields=['count', 'sum'],
+                     location__geom_within=geom_within, **org_query),
+                dict(start=last_start, end=end, min_points=1,
+                     fields=['count', 'sum'],
+                     location__geom_within=geom_within, **org_query),
+            ]
+        return [dict(start=start, end=end, min_points=1, fields=statistic,
+                     location__geom_within=geom_within, **org_query)]
 
-        self.get(
-            start=start,
-            end=end,
-            min_points=1,
-            fields=statistic,
-            location__geom_within=geom_within,
-            **org_query
-        )
+    def combine_years(self, first_year_results):
+        """
+        Stores the difference (mean last - first year) in the results of the
+        last year, given the results of the first year.
+        """
+        first_year = {}
+        for r in first_year_results:
+            try:
+                first_year[r['location']['uuid']] = {
+                  'first_value_timestamp': r['first_value_timestamp'],
+                  'mean': r['events'][0]['sum'] / r['events'][0]['count']
+                }
+            except IndexError:
+                first_year[r['location']['uuid']] = {
+                  'first_value_timestamp': np.nan,
+                  'mean': np.nan
+                }
+        for r in self.results:
+            try:
+                r['events'][0]['difference (mean last - first year)'] = \
+                    r['events'][0]['sum'] / r['events'][0]['count'] - \
+                    first_year[r['location']['uuid']]['mean']
+                r['first_value_timestamp'] = \
+                    first_year[
+                        r['location']['uuid']]['first_value_timestamp']
+            except IndexError:
+                r['events'] = [{
+                    'difference (mean last - first year)': np.nan}]
+                r['first_value_timestamp'] = np.nan
+                r['last_value_timestamp'] = np.nan
+
+    def results_to_array(self, stats):
+        """
+        Columnar view on the results.
+        :param stats: fields of the first event of every result.
+        :return: float array with a row per result and a column per stat
+                 followed by the first and last value timestamps. Results
+                 without events have NaN stats, results without valid
+                 timestamps have NaN for both timestamps.
+        """
+        npts = np.empty((len(self.results), len(stats) + 2))
+        no_event = dict.fromkeys(stats, np.nan)
+        events = [result['events'][0] if len(result['events']) else no_event
+                  for result in self.results]
+        for i, stat in enumerate(stats):
+            npts[:, i] = [event[stat] for event in events]
+        timestamps = npts[:, -2:]
+        timestamps[:, 0] = [result['first_value_timestamp']
+                            for result in self.results]
+        timestamps[:, 1] = [result['last_value_timestamp']
+                            for result in self.results]
+        np.trunc(timestamps, out=timestamps)
+        timestamps[np.isnan(timestamps).any(axis=1)] = np.nan
+        return npts
 
     def ts_to_dict(self, statistic=None, values=None,
                    start_date=None, end_date=None, date_time='js'):
@@ -550,51 +834,38 @@ class TimeSeries(Base):
                 stats1 = (statistic, )
             stats2 = ((0, statistic), )
             start_index = int(statistic == 'mean') + 1
-        ts = []
-        for result in self.results:
-            try:
-                timestamps = [int(result['first_value_timestamp']),
-                              int(result['last_value_timestamp'])]
-            except (ValueError, TypeError):
-                timestamps = [np.nan, np.nan]
-            except TypeError:
-                # int(None)
-                timestamps = [np.nan, np.nan]
-            if not len(result['events']):
-                y = 2 if statistic == 'difference (mean last - first year)' \
-                    else 0
-                ts.append(
-                    [np.nan for _ in range(len(stats1) + y)] + timestamps)
-            else:
-                ts.append([float(result['events'][0][s]) for s in stats1] +
-                          timestamps)
-        npts = np.array(ts)
+        npts = self.results_to_array(stats1)
         if statistic:
             if statistic == 'mean':
-                stat = (npts[:, 0] / npts[:, 1]).reshape(-1, 1)
+                stat = npts[:, 0] / npts[:, 1]
             elif statistic == 'range (max - min)':
-                stat = (npts[:, 1] - npts[:, 0]).reshape(-1, 1)
+                stat = npts[:, 1] - npts[:, 0]
             elif statistic == 'difference (last - first)':
-                stat = (npts[:, 1] - npts[:, 0]).reshape(-1, 1)
+                stat = npts[:, 1] - npts[:, 0]
             else:
-                stat = npts[:, 0].reshape(-1, 1)
-            npts_calculated = np.hstack(
+                stat = npts[:, 0]
+            npts_calculated = np.column_stack(
                 (stat, npts[:, slice(start_index, -1)]))
         else:
-            npts_calculated = np.hstack((
+            npts_calculated = np.column_stack((
                 npts[:, 0:2],
-                (npts[:, 2] / npts[:, 3]).reshape(-1, 1),
-                (npts[:, 1] - npts[:, 0]).reshape(-1, 1),
-
+                npts[:, 2] / npts[:, 3],
+                npts[:, 1] - npts[:, 0],
                 npts[:, 4:]
             ))
 
-        for i, row in enumerate(npts_calculated):
-            location_uuid = self.results[i]['location']['uuid']
+        # Columns to lists once, with NaN as 'NaN', then one dict per location
+        columns = []
+        for i, stat in stats2:
+            column = npts_calculated[:, i].astype(object)
+            column[np.isnan(npts_calculated[:, i])] = 'NaN'
+            columns.append(column.tolist())
+        stat_names = [stat for _, stat in stats2]
+        for result, row in zip(self.results, zip(*columns)):
+            location_uuid = result['location']['uuid']
             loc_dict = values.get(location_uuid, {})
-            loc_dict.update({stat: 'NaN' if np.isnan(row[i]) else row[i]
-                             for i, stat in stats2})
-            loc_dict['timeseries_uuid'] = self.results[i]['uuid']
+            loc_dict.update(zip(stat_names, row))
+            loc_dict['timeseries_uuid'] = result['uuid']
             values[location_uuid] = loc_dict
         npts_min = np.nanmin(npts_calculated, 0)
         npts_max = np.nanmax(npts_calculated, 0)
@@ -1,7 +1,12 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
 # -*- coding: utf-8 -*-
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
 
-# from django.db import models
-# from django.utils.translation import ugettext_lazy as _
+from freq.cache import invalidate_organisations
 
-# Create your models here.
+
+@receiver(user_logged_in)
+def renew_organisations(sender, user, **kwargs):
+    # memberships may have changed since the last login
+    invalidate_organisations(user.get_username())
@@ -0,0 +1,103 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Runs the FREQ chain over many time series with a pool of processes.
+
+Use this for series that can not be stacked for ``freq_calculator.batch``
+(different lengths or breaking points). Results come back in the order of
+the input and a failing series never aborts the rest of the run.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import math
+import os
+import time
+
+import pandas as pd
+
+from freq import freq_calculator as calculator
+
+
+logger = logging.getLogger(__name__)
+
+
+SeriesResult = namedtuple('SeriesResult', ['key', 'result', 'error',
+                                           'seconds'])
+
+
+def analyse(data, bp=10, alpha=0.05, n_lags=2, n_harmonics=3, per=2,
+            frequency='M'):
+    """
+    Runs the chain of freq_calculator.test on a single series.
+    :param data: pd Series with raw observations (loaded first) or an already
+                 loaded array_like.
+    :return: a dictionary with the parameters of every step.
+    """
+    if isinstance(data, pd.Series):
+        data = calculator.load(data=data, frequency=frequency)[1]
+    step_t, _, step_param, _ = calculator.step(
+        data, bp=bp, alpha=alpha, detrend_anyway=True)
+    linear_t, _, linear_param, _ = calculator.linear(
+        step_t, alpha=alpha, detrend_anyway=True)
+    corr_vec = calculator.correlogram(linear_t, n_lags=n_lags)
+    harmonic_t = calculator.harmonic(linear_t, n_harmonics=n_harmonics)[0]
+    _, _, ar_param, aic_model, std_error = calculator.autoregressive(
+        harmonic_t, per=per)
+    return {
+        'step': step_param,
+        'linear': linear_param,
+        'correlogram': corr_vec,
+        'autoregressive': ar_param,
+        'aic': aic_model,
+        'sigma': std_error,
+    }
+
+
+def _analyse_item(item):
+    """
+    Worker: analyses one (key, data, parameters) item, catching any error.
+    """
+    key, data, parameters = item
+    start = time.time()
+    try:
+        result = analyse(data, **parameters)
+        error = None
+    except Exception as e:
+        result = None
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    return SeriesResult(key, result, error, time.time() - start)
+
+
+def run(series, processes=None, chunksize=None, **parameters):
+    """
+    Analyses many series over a pool of processes.
+    :param series: dictionary of series or a list of series (keys are then
+                   the list indices).
+    :param processes: number of worker processes, defaults to the number of
+                      cores. With 1 the series are analysed in this process.
+    :param chunksize: number of series submitted to a worker at once,
+                      defaults to spreading the series over four chunks per
+                      worker.
+    :param parameters: keyword arguments for analyse (bp, alpha, etc.).
+    :return: a list of SeriesResult in the order of series.
+    """
+    if isinstance(series, dict):
+        items = [(key, data, parameters) for key, data in series.items()]
+    else:
+        items = [(key, data, parameters) for key, data in enumerate(series)]
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, int(math.ceil(len(items) / (4.0 * processes))))
+
+    start = time.time()
+    if processes == 1:
+        results = [_analyse_item(item) for item in items]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(_analyse_item, items,
+                                        chunksize=chunksize))
+    failed = sum(result.error is not None for result in results)
+    logger.debug('Analysed %d series (%d failed) with %d processes in %.2fs',
+                 len(results), failed, processes, time.time() - start)
+    return results
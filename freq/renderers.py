@@ -0,0 +1,165 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Response renderers for the api views.
+
+The JSON renderer encodes numpy arrays and scalars directly. Every NaN it
+encodes (in floats, numpy scalars and arrays and chart values) is rendered
+as null, the missing value of JSON; strings like the 'NaN' of
+TimeSeries.ts_to_dict are passed through as they are. By default a chart
+series is rendered as a list of {'x': ..., 'y': ...} points. The columnar
+formats render the same series as parallel x and y arrays, negotiated with
+?format=columnar (or ?format=columnar-binary) or the Accept header.
+"""
+import base64
+
+import numpy as np
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ChartValues(object):
+    """
+    Values of a chart series, stored as x and y arrays. NaN y values are
+    missing values (null in JSON).
+    """
+
+    def __init__(self, x, y):
+        self.x = np.asarray(x)
+        self.y = np.asarray(y, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.y)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        """
+        :return: list of {'x': ..., 'y': ...} points, used by the JSON
+                 encoder of the default renderer.
+        """
+        columns = self.columns()
+        return [{'x': x, 'y': y} for x, y in zip(columns['x'], columns['y'])]
+
+    def columns(self):
+        """
+        :return: dictionary with the x and y values as lists.
+        """
+        y = self.y.astype(object)
+        y[np.isnan(self.y)] = None
+        return {'x': self.x.tolist(), 'y': y.tolist()}
+
+    def binary_columns(self):
+        """
+        :return: dictionary with the x and y values as base64 encoded little
+                 endian float64 buffers, NaN for missing values.
+        """
+        return {
+            'encoding': 'base64-float64',
+            'x': base64.b64encode(
+                self.x.astype('<f8').tobytes()).decode('ascii'),
+            'y': base64.b64encode(
+                self.y.astype('<f8').tobytes()).decode('ascii'),
+        }
+
+
+def nan_to_none(array):
+    """
+    :return: array, with NaN values replaced by None for float arrays.
+    """
+    if array.dtype.kind == 'f':
+        nan = np.isnan(array)
+        if nan.any():
+            array = array.astype(object)
+            array[nan] = None
+    return array
+
+
+# types replace_nan looks into
+NESTED = (float, dict, list, tuple)
+
+
+def replace_nan(data):
+    """
+    Replaces NaN floats in data (nested dictionaries, lists and tuples) by
+    None.
+    """
+    if isinstance(data, float):
+        return None if data != data else data
+    # leaves other than floats are kept without a call per element
+    if isinstance(data, dict):
+        return {key: replace_nan(value) if isinstance(value, NESTED) else value
+                for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [replace_nan(value) if isinstance(value, NESTED) else value
+                for value in data]
+    return data
+
+
+def to_columns(data, binary=False):
+    """
+    Replaces the ChartValues in data (nested dictionaries, lists and tuples)
+    by their columns.
+    """
+    if isinstance(data, ChartValues):
+        return data.binary_columns() if binary else data.columns()
+    if isinstance(data, dict):
+        return {key: to_columns(value, binary) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_columns(value, binary) for value in data]
+    return data
+
+
+class NumpyJSONEncoder(JSONEncoder):
+    """
+    JSON encoder for numpy arrays and scalars, NaN becomes null.
+    """
+
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            return nan_to_none(obj).tolist()
+        if isinstance(obj, np.floating):
+            return None if np.isnan(obj) else float(obj)
+        if isinstance(obj, np.integer):
+            return int(obj)
+        if isinstance(obj, np.bool_):
+            return bool(obj)
+        return super().default(obj)
+
+
+class NumpyJSONRenderer(JSONRenderer):
+    """
+    JSON renderer for responses with numpy arrays and NaN values.
+    Arrays are encoded as a whole instead of element by element. NaN values
+    are rendered as null.
+    """
+    encoder_class = NumpyJSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # NaN floats (and float64 scalars, which are floats) are encoded by
+        # the json module itself, so they are replaced beforehand.
+        return super().render(replace_nan(data), accepted_media_type,
+                              renderer_context)
+
+
+class ColumnarJSONRenderer(NumpyJSONRenderer):
+    """
+    JSON with the chart values as parallel x and y lists.
+    """
+    media_type = 'application/vnd.freq.columnar+json'
+    format = 'columnar'
+    binary = False
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(to_columns(data, self.binary),
+                              accepted_media_type, renderer_context)
+
+
+class ColumnarBinaryRenderer(ColumnarJSONRenderer):
+    """
+    JSON with the chart values as base64 encoded float64 x and y buffers.
+    """
+    media_type = 'application/vnd.freq.columnar-binary+json'
+    format = 'columnar-binary'
+    binary = True
@@ -195,6 +195,47 @@ SESSION_SAVE_EVERY_REQUEST = True
 
 DEFAULT_ORGANISATION_NAME = "test_organisation_debugging_igrac"
 
+# Downloaded timeseries events are cached per process, keyed by timeseries
+# uuid, time window and organisation.
+TIMESERIES_CACHE_SIZE = 128  # number of time windows
+TIMESERIES_CACHE_TTL = 600  # seconds
+# Results of the analysis stages (trend, harmonic, correlogram, AR) are cached
+# per process, keyed by a hash of their input data and their parameters.
+STAGE_CACHE_SIZE = 256  # number of stage results
+STAGE_CACHE_TTL = 600  # seconds
+# Downloaded events are stored per timeseries in this directory, after the
+# first download only newer events are requested. Set to None to disable.
+TIMESERIES_STORE_DIR = os.path.join(BUILDOUT_DIR, 'var', 'timeseries')
+# Stored timeseries are downloaded completely again after this many seconds,
+# to pick up corrections of older events. None never does.
+TIMESERIES_STORE_REVALIDATE = 7 * 24 * 3600
+
+# The organisations of a user are looked up once per ttl in this django
+# cache, they are looked up again after a login or restart.
+ORGANISATIONS_CACHE = 'default'
+ORGANISATIONS_CACHE_TTL = 3600  # seconds
+
+# Downloads of all timeseries of an organisation run in the background, their
+# status records and exports are kept in this directory.
+DOWNLOAD_JOBS_DIR = os.path.join(BUILDOUT_DIR, 'var', 'downloads')
+# See freq.download_jobs.DownloadJobs
+DOWNLOAD_JOBS = {
+    'poll_interval': 2,  # seconds before the first poll of the lizard task
+    'max_poll_interval': 30,  # seconds
+    'ttl': 24 * 3600,  # seconds an export is served before it is renewed
+    # Add 'parquet' and/or 'arrow' to also write the zipped columnar exports,
+    # these need pyarrow and are written for every download.
+    'formats': ('csv',),
+}
+
+# Keep-alive connections to the lizard api, see freq.transport.ConnectionPool
+LIZARD_CONNECTION_POOL = {
+    'maxsize': 10,  # idle connections kept per host
+    'timeout': 60,  # seconds
+    'retries': 2,
+    'backoff': 0.5,  # seconds before the first retry
+}
+
 
 try:
     # User and password are stored in a secretsettings.py script to keep these
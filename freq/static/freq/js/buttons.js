@@ -43,7 +43,7 @@ function changeGraphs(buttonType, altValue, changeTabs){
         }
         var val = JSON.stringify(value);
         var queryUrl = '/' + window.active + '_data/?button=' + buttonType +
-            '&value=' + val;
+            '&value=' + val + '&format=columnar';
         loadData(queryUrl, updateGraphs)
     };
 }
@@ -69,7 +69,41 @@ function extraUpdate(data){
 
 function lastUpdate(data){};
 
+
+function decodeColumn(column, encoding){
+  // base64 encoded little endian float64 buffer to an array, NaN is missing.
+  if(encoding !== 'base64-float64'){ return column; }
+  var bytes = atob(column);
+  var buffer = new Uint8Array(bytes.length);
+  for(var i=0; i < bytes.length; i++){ buffer[i] = bytes.charCodeAt(i); }
+  var floats = new Float64Array(buffer.buffer);
+  var values = new Array(floats.length);
+  for(var j=0; j < floats.length; j++){
+    values[j] = isNaN(floats[j]) ? null : floats[j];
+  }
+  return values;
+}
+
+
+function columnsToPoints(series){
+  // columnar (?format=columnar) series values to the {x, y} points of nvd3.
+  var values = series.values;
+  if(values === undefined || values.x === undefined){ return series; }
+  var x = decodeColumn(values.x, values.encoding);
+  var y = decodeColumn(values.y, values.encoding);
+  var points = new Array(x.length);
+  for(var i=0; i < x.length; i++){ points[i] = {x: x[i], y: y[i]}; }
+  series.values = points;
+  return series;
+}
+
+
 function updateGraphs(data){
+  if(data.graphs !== undefined){
+    for(var i=0; i < data.graphs.length; i++){
+      data.graphs[i].data = data.graphs[i].data.map(columnsToPoints);
+    }
+  }
   extraUpdate(data);
   var graphs = data.graphs;
   if(graphs !== undefined){
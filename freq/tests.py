@@ -3,10 +3,941 @@
 from __future__ import unicode_literals
 from __future__ import print_function
 
+import asyncio
+import base64
+import csv
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import io
+import json
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+import zipfile
+
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
 from django.test import TestCase
+import numpy as np
+import pandas as pd
+
+from freq import async_connector
+from freq import benchmark
+from freq import cache
+from freq import columnar_export
+from freq import download_jobs
+from freq import event_stream
+from freq import freq_calculator as calculator
+from freq import jsdatetime
+from freq import lizard_connector
+from freq import parallel
+from freq import renderers
+from freq import timeseries_store
+from freq import transport
 
 
 class ExampleTest(TestCase):
 
     def test_something(self):
         self.assertEquals(1, 1)
+
+
+class HarmonicTest(TestCase):
+
+    def setUp(self):
+        self.data = benchmark.sample_series(1000)
+
+    def test_matches_reference(self):
+        result = calculator.harmonic(self.data, 3)
+        reference = benchmark._harmonic_reference(self.data, 3)
+        for i in (0, 1, 3, 4):
+            np.testing.assert_allclose(result[i], reference[i], atol=1e-9)
+        # no ties at the threshold, so the same frequencies are below it
+        for param, reference_param in zip(result[2], reference[2]):
+            np.testing.assert_allclose(param, reference_param, atol=1e-9)
+
+    def test_no_harmonics_removes_everything(self):
+        det_serie = calculator.harmonic(self.data, 0)[0]
+        np.testing.assert_allclose(det_serie, 0, atol=1e-9)
+
+
+class CorrelogramTest(TestCase):
+
+    def setUp(self):
+        self.data = benchmark.sample_series(1000) + 100
+
+    def test_matches_reference(self):
+        for n_lags in (2, 10, 400):
+            np.testing.assert_allclose(
+                calculator.correlogram(self.data, n_lags),
+                benchmark._correlogram_reference(self.data, n_lags),
+                atol=1e-10)
+
+    def test_autocorrelation(self):
+        from statsmodels.tsa.stattools import acf, pacf
+        result, partial, band, partial_band = calculator.autocorrelation(
+            self.data, 20)
+        np.testing.assert_allclose(result, acf(self.data, nlags=19),
+                                   atol=1e-10)
+        np.testing.assert_allclose(
+            partial, pacf(self.data, nlags=19, method='ldb'), atol=1e-10)
+        limits = acf(self.data, nlags=19, alpha=0.05)[1]
+        np.testing.assert_allclose(band, limits[:, 1] - result, atol=1e-10)
+        self.assertAlmostEqual(partial_band, 1.959964 / np.sqrt(1000),
+                               places=6)
+        with self.assertRaises(ValueError):
+            calculator.autocorrelation(self.data, 0)
+
+
+class AutoregressiveTest(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        noise = rng.randn(600)
+        self.data = np.zeros(600)
+        for t in range(2, 600):
+            self.data[t] = 0.6 * self.data[t - 1] - 0.3 * self.data[t - 2] + \
+                noise[t]
+        self.data += 10
+
+    def test_matches_yule_walker(self):
+        from statsmodels.regression.linear_model import yule_walker
+        params, sigma2, aic = calculator.autoregressive_orders(self.data, 5)
+        for order in range(1, 6):
+            rho, sigma = yule_walker(self.data, order=order, method='mle')
+            np.testing.assert_allclose(params[order, 1:order + 1], rho)
+            self.assertAlmostEqual(sigma2[order], sigma**2)
+        np.testing.assert_allclose(
+            aic, np.log(sigma2) + 2 * (np.arange(6) + 1) / len(self.data))
+        self.assertLess(aic[2], aic[1])
+        self.assertLess(aic[1], aic[0])
+
+    def test_model(self):
+        det_serie, trend, param, aic_model, std_error = \
+            calculator.autoregressive(self.data, 2)
+        np.testing.assert_allclose(param, [10 * 0.7, 0.6, -0.3], atol=0.3)
+        np.testing.assert_allclose(
+            trend[2:], param[0] + param[1] * self.data[1:-1] +
+            param[2] * self.data[:-2])
+        self.assertAlmostEqual(std_error, np.std(det_serie[2:]), places=2)
+
+    def test_rows(self):
+        rows = np.vstack((self.data, self.data[::-1]))
+        params, sigma2, aic = calculator.autoregressive_orders(rows, 3)
+        for row, series in enumerate(rows):
+            single = calculator.autoregressive_orders(series, 3)
+            np.testing.assert_allclose(params[row], single[0])
+            np.testing.assert_allclose(aic[row], single[2])
+
+
+class MannKendallTest(TestCase):
+
+    def setUp(self):
+        self.data = benchmark.sample_series(400)
+
+    def test_matches_reference(self):
+        s, slope = benchmark._mann_kendall_reference(self.data)
+        param = calculator.mann_kendall(self.data, 0.05)[2]
+        self.assertEqual(param[5], s)
+        self.assertAlmostEqual(param[0], slope)
+
+    def test_bisection_matches_direct_median(self):
+        for data in (self.data, np.round(self.data[:-1]), self.data * 1e-8,
+                     np.ones(300)):
+            self.assertEqual(
+                calculator.sens_slope(data, max_direct=0),
+                benchmark._mann_kendall_reference(data)[1])
+
+    def test_inverted_pairs(self):
+        values = np.random.RandomState(0).permutation(37)
+        first, second = np.triu_indices(len(values), 1)
+        inverted = values[first] > values[second]
+        self.assertEqual(
+            sorted(zip(*map(list, calculator._inverted_pairs(values)))),
+            sorted(zip(first[inverted], second[inverted])))
+
+    def test_inversions_with_ties(self):
+        values = np.array([3, 1, 2, 2, 5, 0, 2])
+        first, second = np.triu_indices(len(values), 1)
+        self.assertEqual(calculator._inversions(values),
+                         (values[first] > values[second]).sum())
+
+
+class LoadTest(TestCase):
+
+    def setUp(self):
+        self.data = benchmark.sample_observations(20000)
+        self.data.iloc[::7] = np.nan
+
+    def assertMatchesReference(self, data, frequency, alias):
+        data_out, data_mod = calculator.load(data=data, frequency=frequency)
+        reference = benchmark._load_reference(data.sort_index(), alias)
+        np.testing.assert_array_equal(
+            data_out.index.values.astype('datetime64[ms]'),
+            reference.index.values.astype('datetime64[ms]'))
+        np.testing.assert_allclose(data_mod, reference.values, rtol=1e-12)
+
+    def test_matches_reference(self):
+        for frequency, alias in (('M', 'ME'), ('W', 'W'), ('D', 'D')):
+            self.assertMatchesReference(self.data, frequency, alias)
+
+    def test_unsorted_observations(self):
+        rng = np.random.RandomState(0)
+        data = self.data.iloc[rng.permutation(len(self.data))]
+        # the order only matters for the first and last date of the output
+        data = pd.concat((data.iloc[[data.index.argmin()]],
+                          data.drop(data.index.min()).drop(data.index.max()),
+                          data.iloc[[data.index.argmax()]]))
+        self.assertMatchesReference(data, 'M', 'ME')
+
+    def test_max_gap(self):
+        # the sample has a gap of about 12 months
+        data_mod = calculator.load(data=self.data, max_gap=13)[1]
+        self.assertFalse(np.isnan(data_mod).any())
+        data_mod = calculator.load(data=self.data, max_gap=6)[1]
+        self.assertIn(np.isnan(data_mod).sum(), (11, 12))
+        labels, resampled = calculator.resample(
+            [0, calculator.MS_PER_DAY, 5 * calculator.MS_PER_DAY],
+            [np.nan, 1., 3.], frequency='D', max_gap=2)
+        self.assertEqual(labels[-1], 5 * calculator.MS_PER_DAY)
+        np.testing.assert_array_equal(
+            resampled, [np.nan, 1, np.nan, np.nan, np.nan, 3])
+
+
+class StepScanTest(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.data = np.concatenate((rng.randn(120), rng.randn(80) + 3)) + 50
+
+    def test_matches_t_test(self):
+        bp, t_test_vals, pvals = calculator.step_scan(self.data)
+        for split in (2, 60, 120, 198):
+            _, _, (_, _, pval, t_test_val), _ = calculator.step(
+                self.data, split, 0.05)
+            self.assertAlmostEqual(t_test_vals[split], t_test_val)
+            self.assertAlmostEqual(pvals[split], pval)
+        self.assertTrue(np.isnan(pvals[[0, 1, 199, 200]]).all())
+
+    def test_finds_step(self):
+        bp, _, pvals = calculator.step_scan(self.data)
+        self.assertEqual(bp, 120)
+        self.assertEqual(pvals[bp], np.nanmin(pvals))
+
+    def test_constant_series(self):
+        self.assertEqual(calculator.step_scan(np.ones(50))[0], 0)
+
+
+class JsDatetimeTest(TestCase):
+
+    def test_matches_per_date_conversion(self):
+        js = [-86400001, -1, 0, 43200000, 1199145600000, 1453216921123.0]
+        index = pd.date_range('1960-03-01', periods=10, freq='7D')
+        dates, js_index = benchmark._js_dates_reference(js, index)
+        np.testing.assert_array_equal(jsdatetime.js_to_datetime64(js), dates)
+        np.testing.assert_array_equal(jsdatetime.datetime64_to_js(index),
+                                      js_index)
+
+    def test_datestrings(self):
+        js = [-86400001, -1, 0, 43200000, 1199145600000, 1453216921123.0]
+        self.assertEqual(jsdatetime.js_to_datestrings(js),
+                         [jsdatetime.js_to_datestring(x) for x in js])
+        self.assertEqual(jsdatetime.js_to_datestrings(js, iso=True),
+                         [jsdatetime.js_to_datestring(x, iso=True)
+                          for x in js])
+
+
+class ColumnarRendererTest(TestCase):
+
+    def setUp(self):
+        self.data = {'graphs': [{'name': '#chart_0 svg', 'data': [{
+            'key': 'Groundwaterlevels (m)',
+            'values': renderers.ChartValues([0, 86400000], [1.5, np.nan])
+        }]}]}
+
+    def test_default_points(self):
+        content = json.loads(
+            renderers.JSONRenderer().render(self.data).decode())
+        self.assertEqual(content['graphs'][0]['data'][0]['values'],
+                         [{'x': 0, 'y': 1.5}, {'x': 86400000, 'y': None}])
+
+    def test_columns(self):
+        content = json.loads(
+            renderers.ColumnarJSONRenderer().render(self.data).decode())
+        self.assertEqual(content['graphs'][0]['data'][0]['values'],
+                         {'x': [0, 86400000], 'y': [1.5, None]})
+
+    def test_binary_columns(self):
+        content = json.loads(
+            renderers.ColumnarBinaryRenderer().render(self.data).decode())
+        values = content['graphs'][0]['data'][0]['values']
+        self.assertEqual(values['encoding'], 'base64-float64')
+        y = np.frombuffer(base64.b64decode(values['y']), dtype='<f8')
+        np.testing.assert_array_equal(y, [1.5, np.nan])
+
+
+class NumpyJSONRendererTest(TestCase):
+
+    def test_numpy_and_nan(self):
+        content = renderers.NumpyJSONRenderer().render({
+            'array': np.array([1.5, np.nan]),
+            'ints': np.arange(2),
+            'scalar': np.float32(2.5),
+            'nan': np.nan,
+            'float32_nan': np.float32('nan'),
+            'values': renderers.ChartValues([0], [np.nan]),
+            'statistic': 'NaN',
+        })
+        self.assertEqual(json.loads(content.decode()), {
+            'array': [1.5, None],
+            'ints': [0, 1],
+            'scalar': 2.5,
+            'nan': None,
+            'float32_nan': None,
+            'values': [{'x': 0, 'y': None}],
+            'statistic': 'NaN',
+        })
+
+    def test_circular_reference_is_not_retried(self):
+        data = []
+        data.append(data)
+        self.assertRaises((ValueError, RecursionError),
+                          renderers.NumpyJSONRenderer().render, data)
+
+
+class BatchTest(TestCase):
+
+    def setUp(self):
+        self.data = np.vstack([benchmark.sample_series(200, seed=seed)
+                               for seed in range(3)])
+
+    def test_matches_single_series(self):
+        table = calculator.batch(self.data, trend='step', bp=[20, 50, 0])
+        for i, bp in enumerate([20, 50, 0]):
+            det_serie, _, param, _ = calculator.step(self.data[i], bp, 0.05)
+            np.testing.assert_allclose(
+                table[['step_mean_a', 'step_mean_b', 'step_pval',
+                       'step_t']].values[i], param)
+            np.testing.assert_allclose(
+                table[['correlogram_0', 'correlogram_1']].values[i],
+                calculator.correlogram(det_serie, 2))
+
+    def test_short_series_are_skipped(self):
+        table = calculator.batch({'long': self.data[0],
+                                  'short': self.data[1][:10]})
+        self.assertTrue(np.isfinite(table.loc['long', 'aic']))
+        self.assertTrue(np.isnan(table.loc['short', 'aic']))
+
+    def test_series_too_short_for_the_parameters(self):
+        table = calculator.batch({'long': self.data[0],
+                                  'short': self.data[1][:40]}, per=13)
+        self.assertTrue(np.isfinite(table.loc['long', 'ar_13']))
+        self.assertTrue(table.loc['short'].isna().all())
+        with self.assertRaises(ValueError):
+            calculator.batch(self.data, per=-1)
+
+    def test_all_columns_without_results(self):
+        for trend in calculator.TREND_TYPES:
+            table = calculator.batch({'short': self.data[0][:10]},
+                                     trend=trend)
+            self.assertEqual(list(table.columns),
+                             list(calculator.batch(self.data, trend=trend)))
+            self.assertTrue(table.loc['short'].isna().all())
+
+
+class ParallelTest(TestCase):
+
+    def test_failures_are_isolated_and_ordered(self):
+        series = {
+            'short': benchmark.sample_series(10),
+            'long': benchmark.sample_series(200),
+            'other': benchmark.sample_series(300),
+        }
+        results = parallel.run(series, processes=2)
+        self.assertEqual([r.key for r in results], list(series.keys()))
+        self.assertIn('CalculatorSampleAmountError', results[0].error)
+        self.assertIsNone(results[0].result)
+
+
+class LRUCacheTest(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(len(lru), 2)
+
+    def test_expires(self):
+        lru = cache.LRUCache(ttl=-1)
+        lru.set('a', 1)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(lru.get_or_set('a', lambda: 2), 2)
+
+
+class StageCacheTest(TestCase):
+
+    def test_reruns_only_on_changed_input(self):
+        calls = []
+
+        def stage(data, factor):
+            calls.append(factor)
+            return data * factor
+
+        data = np.arange(5.0)
+        cache.cached_stage(stage, data=data, factor=2)
+        cache.cached_stage(stage, data=data.copy(), factor=2)
+        self.assertEqual(calls, [2])
+        cache.cached_stage(stage, data=data, factor=3)
+        cache.cached_stage(stage, data=data + 1, factor=3)
+        self.assertEqual(calls, [2, 3, 3])
+
+    def test_series_name_and_index_dtype(self):
+        index = pd.date_range('2000-01-01', periods=3, freq='D')
+        series = pd.Series([1.0, 2.0, 3.0], index=index, name='a')
+        keys = {cache.array_key(series),
+                cache.array_key(series.rename('b')),
+                cache.array_key(series.tz_localize('Europe/Amsterdam'))}
+        self.assertEqual(len(keys), 3)
+
+    def test_stages_with_the_same_name(self):
+        class First(object):
+            @staticmethod
+            def stage(value):
+                return value + 1
+
+        class Second(object):
+            @staticmethod
+            def stage(value):
+                return value + 2
+
+        self.assertEqual(cache.cached_stage(First.stage, value=1), 2)
+        self.assertEqual(cache.cached_stage(Second.stage, value=1), 3)
+
+
+class TsToDictTest(TestCase):
+
+    def test_matches_reference(self):
+        timeseries = lizard_connector.TimeSeries()
+        timeseries.results = benchmark.sample_results(300)
+        response = timeseries.ts_to_dict(start_date=0, end_date=2 * 10**12)
+        values, npts_min, npts_max = benchmark._ts_to_dict_reference(
+            timeseries.results)
+        self.assertEqual(response['values'], values)
+        self.assertEqual(response['extremes']['mean'],
+                         {'min': npts_min[2], 'max': npts_max[2]})
+
+
+class OrganisationsCacheTest(TestCase):
+
+    def setUp(self):
+        self.organisations = [('GGMN', 'ggmn-id'), ('Other', 'other-id')]
+        cache.organisations_cache().set(
+            cache.organisations_key('user'), self.organisations)
+
+    def tearDown(self):
+        cache.invalidate_organisations('user')
+
+    def test_cached_organisations(self):
+        self.assertEqual(cache.user_organisations('user'),
+                         self.organisations)
+
+    def test_login_invalidates(self):
+        user = User.objects.create_user('user')
+        user_logged_in.send(sender=User, request=None, user=user)
+        self.assertIsNone(cache.organisations_cache().get(
+            cache.organisations_key('user')))
+
+
+class TimeSeriesStoreTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.events = (np.arange(10, dtype=np.int64) * 1000,
+                       np.arange(10, dtype=np.float64))
+        self.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def download(self, ts_uuid, start, end, organisation, use_header):
+        self.requests.append(start)
+        timestamps, values = self.events
+        newer = timestamps >= (start or 0)
+        return timestamps[newer], values[newer]
+
+    def test_only_new_events_are_downloaded(self):
+        store = timeseries_store.TimeSeriesStore(self.directory,
+                                                 self.download)
+        timestamps, values = store.events('abc', 2000)
+        np.testing.assert_array_equal(timestamps, np.arange(2, 10) * 1000)
+        self.events = (np.arange(12, dtype=np.int64) * 1000,
+                       np.arange(12, dtype=np.float64))
+        timestamps, values = store.events('abc', 2000)
+        np.testing.assert_array_equal(values, np.arange(2, 12))
+        self.assertEqual(self.requests, [None, 9001])
+        # a window up to the last sync is served from the store
+        store.events('abc', 0, 5000)
+        self.assertEqual(len(self.requests), 2)
+
+    def test_put_and_memory_map(self):
+        store = timeseries_store.TimeSeriesStore(self.directory,
+                                                 self.download)
+        store.put([('abc',) + self.events], organisation='org')
+        timestamps, values = store.events('abc', 0, 0, organisation='org')
+        self.assertIsInstance(values, np.memmap)
+        np.testing.assert_array_equal(values, [0])
+        self.assertEqual(self.requests, [])
+        metadata = list(store.index().values())[0]
+        self.assertEqual((metadata['uuid'], metadata['count']), ('abc', 10))
+
+    def test_sync_without_new_events(self):
+        store = timeseries_store.TimeSeriesStore(self.directory,
+                                                 self.download)
+        store.events('abc', 0)
+        digest = store.digest(('abc', None, False))
+        inode = os.stat(store.path(digest)).st_ino
+        synced = store.metadata(digest)['synced']
+        time.sleep(0.01)
+        timestamps, values = store.events('abc', 0)
+        self.assertEqual(len(timestamps), 10)
+        self.assertEqual(os.stat(store.path(digest)).st_ino, inode)
+        self.assertGreater(store.metadata(digest)['synced'], synced)
+
+    def test_stores_share_the_directory(self):
+        # like two processes with their own store
+        first = timeseries_store.TimeSeriesStore(self.directory,
+                                                 self.download)
+        second = timeseries_store.TimeSeriesStore(self.directory,
+                                                  self.download)
+        first.events('abc', 0)
+        second.events('def', 0)
+        first.events('ghi', 0)
+        self.assertEqual(
+            sorted(metadata['uuid'] for metadata in second.index().values()),
+            ['abc', 'def', 'ghi'])
+
+    def test_revalidate(self):
+        store = timeseries_store.TimeSeriesStore(self.directory,
+                                                 self.download, revalidate=0)
+        store.events('abc', 0)
+        self.events[1][0] = -1
+        timestamps, values = store.events('abc', 0)
+        self.assertEqual(values[0], -1)
+        self.assertEqual(self.requests, [None, None])
+
+
+class StubLizardHandler(BaseHTTPRequestHandler):
+    """
+    Serves ITEMS in pages of PAGE_SIZE like the Lizard api.
+    """
+    ITEMS = list(range(11))
+    PAGE_SIZE = 3
+    TIMESERIES = {
+        'uuid': 'abc',
+        'name': 'GWmBGS',
+        'events': [{'timestamp': i * 1000, 'max': i / 2 if i % 3 else None,
+                    'min': 0} for i in range(1000)]
+    }
+    TASK_RESULT = [
+        {'uuid': 'a', 'name': 'A', 'location': {'uuid': 'loc-a'}, 'events': [
+            {'timestamp': 86400000 * i, 'max': i / 4} for i in range(3)]},
+        {'uuid': 'b', 'name': 'B', 'location': {'uuid': 'loc-b'},
+         'events': []},
+        {'uuid': 'c', 'name': 'C', 'location': {'uuid': 'loc-a'}, 'events': [
+            {'timestamp': -86400000, 'max': None}]},
+    ]
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/missing':
+            self.send_error(404)
+            return
+        if url.path == '/task-result':
+            self.send_json(self.TASK_RESULT)
+            return
+        if url.path == '/task':
+            self.send_json({
+                'task_status': 'SUCCESS',
+                'result_url': 'http://{0}:{1}/task-result'.format(
+                    *self.server.server_address)
+            })
+            return
+        if url.path.startswith('/api/v2/timeseries/') and \
+                url.path != '/api/v2/timeseries/':
+            self.send_json(self.TIMESERIES)
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        page = int(query.get('page', 1))
+        start = (page - 1) * self.PAGE_SIZE
+        next_url = None
+        if start + self.PAGE_SIZE < len(self.ITEMS):
+            query['page'] = page + 1
+            next_url = 'http://{0}:{1}{2}?{3}'.format(
+                *self.server.server_address + (
+                    url.path, urllib.parse.urlencode(query)))
+        self.send_json({
+            'count': len(self.ITEMS),
+            'next': next_url,
+            'results': [{'id': item, 'uuid': 'item-{0}'.format(item)}
+                        for item in self.ITEMS[start:start + self.PAGE_SIZE]]
+        })
+
+    def send_json(self, content):
+        body = json.dumps(content).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServerTestCase(TestCase):
+    handler = StubLizardHandler
+
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), self.handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = 'http://{0}:{1}'.format(*self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class PaginationTest(StubServerTestCase):
+
+    def test_pages_are_fetched_in_order(self):
+        api = lizard_connector.Base(base=self.base, data_type='things')
+        results = api.get(name='x')
+        self.assertEqual([r['id'] for r in results],
+                         StubLizardHandler.ITEMS)
+
+    def test_page_urls(self):
+        api = lizard_connector.Base(base=self.base, data_type='things')
+        api.json = {'count': 7, 'results': [1, 2, 3]}
+        self.assertEqual(
+            api.page_urls('http://x/api/?a=1&offset=3&limit=3'),
+            ['http://x/api/?a=1&offset=3&limit=3',
+             'http://x/api/?a=1&offset=6&limit=3'])
+
+
+class ConnectionPoolTest(StubServerTestCase):
+
+    def test_connections_are_reused(self):
+        pool = transport.ConnectionPool()
+        api = lizard_connector.Base(base=self.base, data_type='things')
+        api.transport = pool
+        api.max_concurrent_pages = 1
+        api.get()
+        self.assertEqual(pool.stats['opened'], 1)
+        self.assertEqual(pool.stats['reused'], 3)
+        pool.clear()
+
+    def test_http_error(self):
+        pool = transport.ConnectionPool()
+        with self.assertRaises(urllib.error.HTTPError):
+            pool.urlopen(self.base + '/missing')
+        pool.clear()
+
+
+class EventStreamTest(StubServerTestCase):
+
+    def test_decode_in_small_chunks(self):
+        content = json.dumps({
+            'name': 'not the "events": [ key',
+            'events': [{'timestamp': 1, 'max': 2.5},
+                       {'timestamp': 2, 'max': None}],
+            'location': {'events': []}
+        }).encode()
+        document, events = event_stream.decode_events(
+            io.BytesIO(content), chunk_size=5)
+        self.assertEqual(document['name'], 'not the "events": [ key')
+        self.assertEqual(document['events'], [])
+        self.assertEqual(len(events), 2)
+        np.testing.assert_equal(events[0][0], [1, 2])
+        np.testing.assert_equal(events[0][1], [2.5, np.nan])
+
+    def test_events_that_are_not_scanned(self):
+        content = json.dumps({'events': [
+            {'timestamp': 1, 'max': 1.5},
+            {'timestamp': 2, 'max': 2, 'comment': '{"timestamp": 0}'},
+            {'timestamp': 3, 'max': '3.5'},
+            {'max': -4e-1, 'timestamp': 4}]}).encode()
+        for chunk_size in (7, 2**16):
+            events = event_stream.decode_events(
+                io.BytesIO(content), chunk_size=chunk_size)[1]
+            np.testing.assert_equal(events[0][0], [1, 2, 3, 4])
+            np.testing.assert_equal(events[0][1], [1.5, 2, 3.5, -0.4])
+
+    def test_timeseries_uuid(self):
+        ts = lizard_connector.TimeSeries(base=self.base)
+        ts.uuid('abc', events_field='max')
+        timestamps, values = ts.events[0]
+        self.assertEqual(ts.results[0]['uuid'], 'abc')
+        self.assertEqual(len(timestamps), 1000)
+        self.assertEqual(values[1], 0.5)
+        self.assertTrue(np.isnan(values[3]))
+
+
+class LocationUUIDTest(StubServerTestCase):
+
+    def test_timeseries_are_downloaded(self):
+        timeseries = lizard_connector.TimeSeries(base=self.base)
+        results = timeseries.location_uuid('abc')
+        self.assertEqual(len(results), len(StubLizardHandler.ITEMS))
+        self.assertEqual(results[0]['uuid'], 'abc')
+        self.assertEqual(len(results[0]['events']), 1000)
+
+    def test_metadata_only(self):
+        timeseries = lizard_connector.TimeSeries(base=self.base)
+        results = timeseries.location_uuid('abc', metadata_only=True)
+        self.assertEqual([r['uuid'] for r in results],
+                         ['item-{0}'.format(i)
+                          for i in StubLizardHandler.ITEMS])
+
+
+class AsyncConnectorTest(StubServerTestCase):
+
+    def test_concurrent_requests(self):
+        locations = async_connector.AsyncLocations(base=self.base)
+        things = async_connector.AsyncBase(base=self.base, data_type='things')
+        location_results, thing_results = async_connector.run(
+            locations.bbox((0, 0), (1, 1)), things.get(name='x'))
+        self.assertEqual([r['id'] for r in location_results],
+                         StubLizardHandler.ITEMS)
+        self.assertEqual(thing_results, things.results)
+        self.assertEqual(len(things.results), len(StubLizardHandler.ITEMS))
+
+    def test_location_uuid(self):
+        timeseries = async_connector.AsyncTimeSeries(base=self.base)
+        results = async_connector.run(timeseries.location_uuid('abc'))[0]
+        self.assertEqual(len(results), len(StubLizardHandler.ITEMS))
+        self.assertEqual(results[0]['uuid'], 'abc')
+
+    def test_location_uuid_concurrency(self):
+        active = []
+        peak = []
+
+        class CountingTimeSeries(async_connector.AsyncTimeSeries):
+            max_concurrent_timeseries = 2
+
+            async def uuid(self, *args, **kwargs):
+                active.append(self)
+                peak.append(len(active))
+                await asyncio.sleep(0.01)
+                active.remove(self)
+
+        timeseries = CountingTimeSeries(base=self.base)
+        async_connector.run(timeseries.location_uuid('abc'))
+        self.assertEqual(len(peak), len(StubLizardHandler.ITEMS))
+        self.assertEqual(max(peak), 2)
+
+    def test_failed_query_is_empty(self):
+        missing = async_connector.AsyncBase(base=self.base,
+                                            data_type='things')
+        missing.base_url = self.base + '/missing'
+        self.assertEqual(async_connector.run(missing.get())[0], [])
+
+    def test_errors_are_raised(self):
+        things = async_connector.AsyncBase(base=self.base, data_type='things')
+        things.max_results = 5
+        with self.assertRaises(lizard_connector.LizardApiError):
+            async_connector.run(things.get())
+
+
+class TaskResultTest(StubServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.task = lizard_connector.TaskAPI(base=self.base)
+        self.task.spool_events(self.base + '/task-result')
+
+    def test_csv_rows(self):
+        self.assertEqual(list(self.task.csv_rows()), [
+            ['A', 'a', '01-01-1970', 0.0],
+            ['A', 'a', '02-01-1970', 0.25],
+            ['A', 'a', '03-01-1970', 0.5],
+            ['C', 'c', '31-12-1969', None],
+        ])
+
+    def test_timeseries_events(self):
+        events = list(self.task.timeseries_events())
+        self.assertEqual([uuid for uuid, _, _ in events], ['a', 'b', 'c'])
+        self.assertEqual([len(timestamps) for _, timestamps, _ in events],
+                         [3, 0, 1])
+        np.testing.assert_array_equal(events[0][2], [0, 0.25, 0.5])
+
+    @unittest.skipUnless(columnar_export.available(), 'requires pyarrow')
+    def test_arrow_export(self):
+        import pyarrow as pa
+        header = [['a', 'A', 'loc A', 1.0, 2.0], ['b', 'B', 'loc B', 3.0, 4.0],
+                  ['c', 'C', 'loc C', 5.0, 6.0]]
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(
+            columnar_export.export_chunks(header, self.task, 'arrow'))))
+        self.assertEqual(archive.namelist(),
+                         ['timeseries.arrow', 'events.arrow'])
+        timeseries = pa.ipc.open_stream(
+            archive.read('timeseries.arrow')).read_all()
+        self.assertEqual(timeseries.column('location_name').to_pylist(),
+                         ['loc A', 'loc B', 'loc C'])
+        events = pa.ipc.open_stream(archive.read('events.arrow')).read_all()
+        self.assertEqual(events.column('uuid').to_pylist(),
+                         ['a', 'a', 'a', 'c'])
+        timestamps = events.column('timestamp').cast(pa.int64())
+        self.assertEqual(timestamps.to_pylist(),
+                         [0, 86400000, 172800000, -86400000])
+        self.assertEqual(events.column('value').to_pylist(),
+                         [0.0, 0.25, 0.5, None])
+
+
+class StubTaskHandler(StubLizardHandler):
+    """
+    Serves the locations of the timeseries in the task result.
+    """
+    LOCATIONS = [
+        {'uuid': 'loc-a', 'name': 'Location A',
+         'geometry': {'coordinates': [1.0, 2.0]}},
+        {'uuid': 'loc-b', 'name': 'Location B',
+         'geometry': {'coordinates': [3.0, 4.0]}},
+    ]
+
+    def do_GET(self):
+        if self.path.startswith('/api/v2/locations/'):
+            self.send_json({'count': len(self.LOCATIONS), 'next': None,
+                            'results': self.LOCATIONS})
+            return
+        super().do_GET()
+
+
+class StubDownloadJobs(download_jobs.DownloadJobs):
+
+    def start_task(self, organisation, use_header):
+        return self.base + '/task', {}
+
+
+class DownloadJobsTest(StubServerTestCase):
+    handler = StubTaskHandler
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.jobs = StubDownloadJobs(self.directory, base=self.base,
+                                     poll_interval=0.01)
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.directory)
+
+    def wait(self, organisation):
+        for _ in range(500):
+            job = self.jobs.status(organisation)
+            if job['status'] in (download_jobs.SUCCESS, download_jobs.FAILURE):
+                return job
+            time.sleep(0.01)
+        self.fail('Download job did not finish')
+
+    def test_job_writes_csv(self):
+        self.assertIsNone(self.jobs.status('org'))
+        self.jobs.start('org')
+        job = self.wait('org')
+        self.assertEqual(job['status'], download_jobs.SUCCESS)
+        with open(self.jobs.export_path(job)) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[:5], [
+            ['uuid', 'name', 'location_name', 'x', 'y'],
+            ['a', 'A', 'Location A', '1.0', '2.0'],
+            ['b', 'B', 'Location B', '3.0', '4.0'],
+            ['c', 'C', 'Location A', '1.0', '2.0'],
+            [],
+        ])
+        self.assertEqual(rows[-1], ['C', 'c', '31-12-1969', ''])
+        self.assertEqual(len(rows), 10)
+
+    def test_only_configured_formats_are_written(self):
+        self.jobs.start('org')
+        job = self.wait('org')
+        self.assertEqual(list(job['files']), ['csv'])
+        self.assertIsNone(self.jobs.export_path(job, 'parquet'))
+
+    @unittest.skipUnless(columnar_export.available(), 'requires pyarrow')
+    def test_columnar_formats(self):
+        self.jobs = StubDownloadJobs(self.directory, base=self.base,
+                                     poll_interval=0.01,
+                                     formats=('csv', 'arrow'))
+        self.jobs.start('org')
+        job = self.wait('org')
+        self.assertEqual(sorted(job['files']), ['arrow', 'csv'])
+        self.assertTrue(
+            zipfile.is_zipfile(self.jobs.export_path(job, 'arrow')))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, StubDownloadJobs, self.directory,
+                          formats=('xlsx',))
+
+    def test_stale_after_follows_poll_interval(self):
+        self.assertEqual(self.jobs.stale_after, 120)
+        jobs = StubDownloadJobs(self.directory, max_poll_interval=5)
+        self.assertEqual(jobs.stale_after, 20)
+
+    def test_finished_job_is_not_restarted(self):
+        self.jobs.start('org')
+        job = self.wait('org')
+        self.assertEqual(self.jobs.start('org')['started'], job['started'])
+
+    def test_failed_task(self):
+        self.jobs.start_task = lambda organisation, use_header: (
+            self.base + '/missing', {})
+        self.jobs.start('org')
+        self.assertEqual(self.wait('org')['status'], download_jobs.FAILURE)
+
+    def test_interrupted_job(self):
+        self.jobs.update({'id': self.jobs.digest('org', False),
+                          'status': download_jobs.PENDING})
+        self.assertEqual(self.jobs.status('org')['status'],
+                         download_jobs.PENDING)
+        self.jobs.stale_after = -1
+        self.assertEqual(self.jobs.status('org')['status'],
+                         download_jobs.FAILURE)
+
+    def test_job_locked_by_another_process(self):
+        digest = self.jobs.digest('org', False)
+        self.assertTrue(self.jobs.acquire(digest))
+        self.assertIsNone(self.jobs.start('org'))
+        self.assertIsNone(self.jobs.status('org'))
+        # a lock left by a stopped process is broken
+        os.utime(self.jobs.path(digest, '.lock'),
+                 (0, time.time() - download_jobs.LOCK_TIMEOUT - 1))
+        self.assertEqual(self.jobs.start('org')['status'],
+                         download_jobs.PENDING)
+        self.assertEqual(self.wait('org')['status'], download_jobs.SUCCESS)
+        self.assertFalse(os.path.exists(self.jobs.path(digest, '.lock')))
+
+    def test_heartbeat(self):
+        job = self.jobs.update({'id': self.jobs.digest('org', False),
+                                'status': download_jobs.STARTED})
+        beat = self.jobs.heartbeat(job)
+        updated = job['updated']
+        beat()
+        self.assertEqual(self.jobs.status('org')['updated'], updated)
+        self.jobs.max_poll_interval = -1
+        list(self.jobs.heartbeats(job, range(3)))
+        self.assertGreater(self.jobs.status('org')['updated'], updated)
@@ -0,0 +1,223 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Local store of downloaded timeseries events.
+
+The events of a timeseries are downloaded once. After that only the events
+newer than the last stored event are requested from lizard and appended to
+the store. Every so often a timeseries is downloaded completely again, to pick
+up corrections of older events.
+
+Every timeseries is a single .npy file with a 2 x n int64 array: the js
+timestamps and the bits of the float64 values. Files are memory-mapped, so
+reading a stored timeseries is a page cache hit without copies. The metadata
+of a timeseries is a small JSON file next to its array, so processes sharing
+the store never rewrite each other's metadata.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from freq import jsdatetime
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimeSeriesStore(object):
+    """
+    Events of timeseries stored as memory-mapped numpy arrays in a directory,
+    one file per timeseries uuid, organisation and login.
+    :param directory: directory of the store, created when missing.
+    :param download: function(ts_uuid, start, end, organisation, use_header)
+                     returning int64 js timestamps and float64 values of the
+                     events from start (None for all events) to end.
+    :param revalidate: seconds after which a timeseries is downloaded
+                       completely again. None never does.
+    """
+
+    def __init__(self, directory, download, revalidate=None):
+        self.directory = directory
+        self.download = download
+        self.revalidate = revalidate
+        self._locks = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def path(self, digest, suffix='.npy'):
+        return os.path.join(self.directory, digest + suffix)
+
+    def metadata(self, digest):
+        """
+        :return: dictionary with the metadata (uuid, organisation, use_header,
+                 synced, validated, count, first and last timestamp) of a
+                 stored timeseries, None when it is not stored (or the file is
+                 unreadable).
+        """
+        path = self.path(digest, '.json')
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError:
+            return None
+        except ValueError:
+            logger.warning('Unreadable timeseries store metadata %s', path)
+            return None
+
+    def index(self):
+        """
+        :return: dictionary with the metadata of all stored timeseries by
+                 digest of their key.
+        """
+        index = {}
+        for path in glob.glob(self.path('*', '.json')):
+            digest = os.path.basename(path)[:-len('.json')]
+            metadata = self.metadata(digest)
+            if metadata is not None:
+                index[digest] = metadata
+        return index
+
+    def write_atomic(self, path, write, suffix):
+        # written to a temporary file first, so readers never see half a file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=suffix)
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp_path, path)
+
+    def load(self, key):
+        """
+        :return: dictionary with the timestamps and values arrays
+                 (read-only, memory-mapped), the js timestamp up to which the
+                 events are synced, the time (in seconds) of the last
+                 complete download and all metadata. None when the
+                 timeseries is not stored (or the file is unreadable).
+        """
+        digest = self.digest(key)
+        metadata = self.metadata(digest)
+        if metadata is None:
+            return None
+        try:
+            events = np.load(self.path(digest), mmap_mode='r')
+        except (IOError, ValueError) as e:
+            logger.warning('Unreadable timeseries store file %s: %s',
+                           self.path(digest), e)
+            return None
+        return {
+            'timestamps': events[0],
+            'values': events[1].view(np.float64),
+            'synced': metadata['synced'],
+            'validated': metadata['validated'],
+            'metadata': metadata,
+        }
+
+    def save(self, key, timestamps, values, synced, validated):
+        """
+        Stores the events of a timeseries. The metadata is written after the
+        events, so it never claims events that are not stored yet.
+        """
+        digest = self.digest(key)
+        events = np.empty((2, len(timestamps)), dtype=np.int64)
+        events[0] = timestamps
+        events[1] = np.ascontiguousarray(values, dtype=np.float64).view(
+            np.int64)
+        self.write_atomic(self.path(digest),
+                          lambda f: np.save(f, events), '.npy')
+        ts_uuid, organisation, use_header = key
+        self.write_metadata(digest, {
+            'uuid': ts_uuid,
+            'organisation': organisation,
+            'use_header': use_header,
+            'synced': int(synced),
+            'validated': float(validated),
+            'count': len(timestamps),
+            'first': int(timestamps[0]) if len(timestamps) else None,
+            'last': int(timestamps[-1]) if len(timestamps) else None,
+        })
+
+    def write_metadata(self, digest, metadata):
+        self.write_atomic(self.path(digest, '.json'),
+                          lambda f: f.write(json.dumps(metadata).encode()),
+                          '.tmp')
+
+    def put(self, events, organisation=None, use_header=False):
+        """
+        Stores the complete events of timeseries, downloaded elsewhere.
+        :param events: iterable of (ts_uuid, timestamps, values).
+        """
+        synced, validated = jsdatetime.now_js(), time.time()
+        for ts_uuid, timestamps, values in events:
+            self.save((ts_uuid, organisation, use_header), timestamps, values,
+                      synced, validated)
+
+    def lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def sync(self, ts_uuid, organisation=None, use_header=False):
+        """
+        Brings the stored events of a timeseries up to date.
+        :return: int64 js timestamps and float64 values of all stored events.
+        """
+        key = (ts_uuid, organisation, use_header)
+        with self.lock(key):
+            stored = self.load(key)
+            now = jsdatetime.now_js()
+            expired = stored is None or (
+                self.revalidate is not None and
+                time.time() - stored['validated'] > self.revalidate)
+            if expired or not len(stored['timestamps']):
+                timestamps, values = self.download(
+                    ts_uuid, None, now, organisation, use_header)
+                self.save(key, timestamps, values, now, time.time())
+                return timestamps, values
+            timestamps, values = stored['timestamps'], stored['values']
+            new_timestamps, new_values = self.download(
+                ts_uuid, int(timestamps[-1]) + 1, now, organisation,
+                use_header)
+            newer = new_timestamps > timestamps[-1]
+            logger.debug('%d new events for timeseries %s', newer.sum(),
+                         ts_uuid)
+            if not newer.any():
+                # only the time up to which the events are synced changed
+                self.write_metadata(self.digest(key),
+                                    dict(stored['metadata'], synced=int(now)))
+                return timestamps, values
+            timestamps = np.concatenate((timestamps, new_timestamps[newer]))
+            values = np.concatenate((values, new_values[newer]))
+            self.save(key, timestamps, values, now, stored['validated'])
+            return timestamps, values
+
+    def events(self, ts_uuid, start, end=None, organisation=None,
+               use_header=False):
+        """
+        Events of a timeseries in a time window. The store is synced first,
+        unless it is already synced up to end.
+        :param start: js timestamp of the start of the window.
+        :param end: js timestamp of the end of the window, defaults to now.
+        :return: int64 js timestamps and float64 values, views on the
+                 memory-mapped store when no sync was needed.
+        """
+        key = (ts_uuid, organisation, use_header)
+        stored = self.load(key)
+        if stored is not None and end is not None and \
+                end <= stored['synced'] and (
+                    self.revalidate is None or
+                    time.time() - stored['validated'] <= self.revalidate):
+            timestamps, values = stored['timestamps'], stored['values']
+        else:
+            timestamps, values = self.sync(ts_uuid, organisation, use_header)
+        first = np.searchsorted(timestamps, start, side='left')
+        last = len(timestamps) if end is None else np.searchsorted(
+            timestamps, end, side='right')
+        return timestamps[first:last], values[first:last]
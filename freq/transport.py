@@ -0,0 +1,196 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Keep-alive HTTP transport shared by the lizard api clients.
+
+Connections are pooled per host, so consecutive requests to the same server
+reuse the TCP (and TLS) connection instead of opening a new one per url.
+"""
+import http.client
+import logging
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+RETRY_CODES = (502, 503, 504)
+CONNECTION_ERRORS = (http.client.HTTPException, ConnectionError,
+                     socket.timeout)
+
+
+class PooledResponse(object):
+    """
+    A response that gives its connection back to the pool when closed.
+    Use as a context manager, like the response of urllib.request.urlopen.
+    """
+
+    def __init__(self, pool, key, connection, response, url):
+        self.pool = pool
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.msg
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.connection is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            # the response was read completely, the connection can be reused
+            self.pool.release(self.key, self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of keep-alive HTTP(S) connections per host.
+    :param maxsize: maximum number of idle connections kept per host.
+    :param timeout: socket timeout in seconds.
+    :param retries: number of retries of a request after a connection error
+                    or a 502, 503 or 504 response.
+    :param backoff: seconds to wait before the first retry, doubled for every
+                    next retry.
+    """
+
+    def __init__(self, maxsize=10, timeout=60, retries=2, backoff=0.5):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """
+        Counters of connections opened and reused and requests retried.
+        """
+        return {
+            'opened': self.opened,
+            'reused': self.reused,
+            'retried': self.retried,
+        }
+
+    def acquire(self, key):
+        """
+        :return: an idle connection for key, or a new one, and whether the
+                 connection is reused.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        scheme, netloc = key
+        if scheme == 'https':
+            connection = http.client.HTTPSConnection(netloc,
+                                                     timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(netloc,
+                                                    timeout=self.timeout)
+        return connection, False
+
+    def release(self, key, connection):
+        """
+        Gives a connection back to the pool, or closes it when the pool of
+        key is full.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """
+        Closes all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def urlopen(self, url, headers=None, max_redirects=5):
+        """
+        GETs an url over a pooled connection. Redirects are followed.
+        :param url: the full url.
+        :param headers: dictionary with request headers.
+        :return: a PooledResponse, close it (or use it as a context manager)
+                 to give the connection back to the pool.
+        :raises urllib.error.HTTPError: for responses with status >= 400.
+        """
+        for _ in range(max_redirects + 1):
+            response = self._request(url, headers or {})
+            if response.status not in REDIRECT_CODES:
+                break
+            location = response.headers.get('Location')
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+        if response.status >= 400:
+            response.read()
+            response.close()
+            raise urllib.error.HTTPError(url, response.status,
+                                         response.response.reason,
+                                         response.headers, None)
+        return response
+
+    def _request(self, url, headers):
+        scheme, netloc, path, query, _ = urllib.parse.urlsplit(url)
+        key = (scheme, netloc)
+        target = (path or '/') + ('?' + query if query else '')
+        attempt = 0
+        while True:
+            connection, reused = self.acquire(key)
+            try:
+                connection.request('GET', target, headers=headers)
+                response = connection.getresponse()
+            except CONNECTION_ERRORS as e:
+                connection.close()
+                if reused:
+                    # the server closed the idle connection in the meantime
+                    continue
+                error = e
+                status = None
+            else:
+                if response.status not in RETRY_CODES or \
+                        attempt >= self.retries:
+                    return PooledResponse(self, key, connection, response,
+                                          url)
+                response.read()
+                connection.close()
+                error = None
+                status = response.status
+            if attempt >= self.retries:
+                raise error
+            wait = self.backoff * 2 ** attempt
+            attempt += 1
+            with self._lock:
+                self.retried += 1
+            logger.debug('Retry %d of %s in %.1fs after %s', attempt, url,
+                         wait, error or status)
+            time.sleep(wait)
@@ -1,7 +1,6 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
 # -*- coding: utf-8 -*-
 import copy
-import csv
 import datetime
 import json
 import logging
@@ -10,32 +9,44 @@ import re
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from django.views.generic.base import TemplateView
-from django.http import HttpResponse
+from django.http import FileResponse
 from django.conf import settings
 from django.shortcuts import redirect
 
 import numpy as np
 import pandas as pd
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response as RestResponse
 from rest_framework.views import APIView
 from lizard_auth_client.models import Organisation
 
 import freq.jsdatetime as jsdt
+from freq import async_connector
+from freq import download_jobs
+from freq.async_connector import AsyncGroundwaterLocations
+from freq.async_connector import AsyncGroundwaterTimeSeries
 from freq.buttons import *
+from freq.cache import cached_stage
+from freq.cache import invalidate_organisations
+from freq.cache import timeseries_events
+from freq.cache import user_organisations
 import freq.freq_calculator as calculator
 from freq.lizard_connector import Filters
-from freq.lizard_connector import GroundwaterLocations
 from freq.lizard_connector import GroundwaterTimeSeries
 from freq.lizard_connector import LizardApiError
 from freq.lizard_connector import RasterFeatureInfo
 from freq.lizard_connector import RasterLimits
-from freq.lizard_connector import Users
-from freq.lizard_connector import TaskAPI
+from freq.renderers import ChartValues
+from freq.renderers import ColumnarBinaryRenderer
+from freq.renderers import ColumnarJSONRenderer
+from freq.renderers import NumpyJSONRenderer
 
 logger = logging.getLogger(__name__)
 
 
 TIMESERIES_MEASUREMENT_FREQUENCY = 'M'
+# highest order of the AIC curve of the autoregressive models
+AR_MAX_ORDER = 10
 DEFAULT_STATE = {
     'login': {
         'selected_organisation': '',
@@ -97,7 +108,6 @@ DEFAULT_STATE = {
         'frequency': 'disabled'
     },
     'download': {
-        'organisations': {},
         'error_message': ""
     }
 }
@@ -138,7 +148,6 @@ class BaseViewMixin(object):
 
     def instantiate_session(self, preserve_download=True):
         download = self.request.session.get('download', {
-            'organisations': {},
             'error_message': ""
         })
         self.request.session['session_is_set'] = True
@@ -233,6 +242,8 @@ class BaseViewMixin(object):
             'error_message']
         if not message and self.download_status == "btn-success":
             message = "Download ready for this organisation. Please click Download to get the requested csv."
+        elif not message and self.download_status == "btn-danger":
+            message = self.download_job['message']
         try:
             # We only show this message once.
             self.set_session_value('download', 'error_message', '')
@@ -293,16 +304,13 @@ class BaseViewMixin(object):
 
     @cached_property
     def timeseries(self):
-        ts = GroundwaterTimeSeries(use_header=self.logged_in)
         page = self.request.GET.get('active', 'startpage')
         uuid = self.request.session[page]['uuid']
-        data = []
+        data = ChartValues([], [])
         if uuid != "EMPTY":
-            ts.uuid(ts_uuid=self.request.session[page]['uuid'],
-                    organisation=self.selected_organisation_id, **self.time_window)
-            if len(ts.results):
-                data = [{'y': x['max'], 'x': x['timestamp']}
-                                 for x in ts.results[0]['events']]
+            data = ChartValues(*timeseries_events(
+                ts_uuid=uuid, organisation=self.selected_organisation_id,
+                use_header=self.logged_in, **self.time_window))
 
         self.data = {
             'values': data,
@@ -397,22 +405,23 @@ class BaseViewMixin(object):
         )
 
     @cached_property
-    def task(self):
-        url = self.request.session.get('download', {'organisations': {}}).get(
-            'organisations', {}).get(
-            self.selected_organisation_id, {}).get("url")
-        print(url)
-        task = TaskAPI(use_header=self.logged_in)
-        task.poll(url=url)
-        return task
+    def download_job(self):
+        """
+        Status record of the download of the selected organisation, None
+        when it was not started. Read from disk, see freq.download_jobs.
+        """
+        return download_jobs.download_jobs().status(
+            self.selected_organisation_id, use_header=self.logged_in)
+
+    @cached_property
+    def download_task_status(self):
+        if self.download_job is None:
+            return "NONE"
+        return self.download_job['status']
 
     @cached_property
     def downloading(self):
-        return self.request.session.get(
-            'download', {'organisations': {}}
-        ).get('organisations', {}).get(
-            self.selected_organisation_id, {'downloading': False}
-        )['downloading']
+        return self.download_job is not None
 
     @cached_property
     def download_status(self):
@@ -422,7 +431,7 @@ class BaseViewMixin(object):
                 "FAILURE": "btn-danger",
                 "PENDING": "btn-info",
                 "STARTED": "btn-info",
-                "NONE": ""}[self.task.status]
+                "NONE": ""}[self.download_task_status]
         return ""
 
     @cached_property
@@ -433,7 +442,7 @@ class BaseViewMixin(object):
                 "FAILURE": "Download failed",
                 "PENDING": "Downloading...",
                 "STARTED": "Download preparing...",
-                "NONE": "Download"}[self.task.status]
+                "NONE": "Download"}[self.download_task_status]
         return "Download"
 
     @cached_property
@@ -444,7 +453,7 @@ class BaseViewMixin(object):
                 "FAILURE": "hidden",
                 "PENDING": "hidden",
                 "STARTED": "hidden",
-                "NONE": ""}[self.task.status]
+                "NONE": ""}[self.download_task_status]
         return ""
 
     # ------------------------------------------------------------------------ #
@@ -452,8 +461,7 @@ class BaseViewMixin(object):
     @cached_property
     def organisations_id_name(self):
         if self.logged_in:
-            users = Users(use_header=True)
-            return users.get_organisations(username=self.user)
+            return user_organisations(self.user.get_username())
         else:
             return []
 
@@ -600,8 +608,9 @@ class TimeSeriesByLocationUUIDView(StartPageBaseView):
     @cached_property
     def timeseries(self):
         ts = GroundwaterTimeSeries(use_header=self.logged_in)
+        # the events are downloaded once a timeseries is selected
         ts.location_uuid(organisation=self.selected_organisation_id,
-                         loc_uuid=self.uuid)
+                         loc_uuid=self.uuid, metadata_only=True)
         return ts.results
 
     @cached_property
@@ -729,6 +738,7 @@ class TrendDetectionView(BaseView):
             "Both trends",
             "Linear trend",
             "Step trend",
+            "Mann-Kendall trend",
             "No trend"
         ]
     )
@@ -793,6 +803,9 @@ class FrequencyView(BaseView):
 
 class BaseApiView(BaseViewMixin, APIView):
     statistics = []
+    # chart values as x and y arrays with ?format=columnar(-binary)
+    renderer_classes = (NumpyJSONRenderer, BrowsableAPIRenderer,
+                        ColumnarJSONRenderer, ColumnarBinaryRenderer)
 
     def get(self, request, *args, **kwargs):
         if self.button == 'datepicker':
@@ -822,13 +835,12 @@ class BaseApiView(BaseViewMixin, APIView):
 
     def pd_timeseries_from_json(self, json_data, name=''):
         # store results in a numpy array
-        dates = np.array(
-            [jsdt.js_to_datestring(x['x'], iso=True) for x in json_data],
-            dtype='datetime64'
-        )
-        values = np.array([
-            np.nan if y['y'] is None else y['y'] for y in json_data
-        ])
+        if isinstance(json_data, ChartValues):
+            dates = jsdt.js_to_datetime64(json_data.x)
+            values = json_data.y
+        else:
+            dates = jsdt.js_to_datetime64([x['x'] for x in json_data])
+            values = np.array([y['y'] for y in json_data], dtype=np.float64)
         index = pd.DatetimeIndex(dates, freq='infer')
         # build a timeseries object so we can compare it with other timeseries
         timeseries = pd.Series(values, index=index, name=name)
@@ -836,7 +848,8 @@ class BaseApiView(BaseViewMixin, APIView):
 
     def load_timeseries(self, timeseries_values, name):
         timeseries_raw = self.pd_timeseries_from_json(timeseries_values, name)
-        return calculator.load(
+        return cached_stage(
+            calculator.load,
             data=timeseries_raw,
             data_path=None,
             init_date=None,
@@ -847,17 +860,15 @@ class BaseApiView(BaseViewMixin, APIView):
         )
 
     def series_to_js(self, npseries, index, key, color='#2980b9', dates=True):
-        try:
-            values = [
-                {'x': jsdt.datetime_to_js(index[i]) if dates else float(
-                    index[i]), 'y': float(value)} for i, value in
-                enumerate(npseries)
-            ]
-        except IndexError:
-            values = [{'x': i, 'y': float(value)} for i, value in enumerate(
-                npseries)]
+        values = np.asarray(npseries, dtype=np.float64)
+        if len(index) < len(values):
+            x = np.arange(len(values))
+        elif dates:
+            x = jsdt.datetime64_to_js(index[:len(values)])
+        else:
+            x = np.asarray(index[:len(values)], dtype=np.float64)
         return {
-            'values': values,
+            'values': ChartValues(x, values),
             'key': key,
             'color': color
         }
@@ -865,7 +876,8 @@ class BaseApiView(BaseViewMixin, APIView):
     def linear_trend(self, timeseries=None, name=None):
         if timeseries is None:
             timeseries = self.pandas_timeseries
-        result = calculator.linear(
+        result = cached_stage(
+            calculator.linear,
             data=timeseries,
             alpha=float(
                 self.request.session['trend_detection']['spinner_0']['value']),
@@ -873,15 +885,41 @@ class BaseApiView(BaseViewMixin, APIView):
         )
         return [result]
 
+    @cached_property
+    def breakpoint_scan(self):
+        """
+        Suggested breaking point and the t-test values and p-values of all
+        breaking points, see calculator.step_scan.
+        """
+        return cached_stage(calculator.step_scan, data=self.pandas_timeseries)
+
     def step_trend(self):
         try:
             split = int(self.request.session['trend_detection']['graph']['x'])
             if split == 0:
-                return
-            breakpoint = jsdt.js_to_datetime(split)
-            return [calculator.step(
+                # no breaking point selected yet, use the suggested one
+                bp = self.breakpoint_scan[0]
+                if bp == 0:
+                    return
+            else:
+                breakpoint = jsdt.js_to_datetime(split)
+                bp = int(self.pandas_timeseries.index.searchsorted(breakpoint))
+            return [cached_stage(
+                calculator.step,
+                data=self.pandas_timeseries,
+                bp=bp,
+                alpha=float(self.request.session[
+                                'trend_detection']['spinner_0']['value']),
+                detrend_anyway=True
+            )]
+        except KeyError:
+            return
+
+    def mann_kendall_trend(self):
+        try:
+            return [cached_stage(
+                calculator.mann_kendall,
                 data=self.pandas_timeseries,
-                bp=int(self.pandas_timeseries.index.searchsorted(breakpoint)),
                 alpha=float(self.request.session[
                                 'trend_detection']['spinner_0']['value']),
                 detrend_anyway=True
@@ -891,7 +929,8 @@ class BaseApiView(BaseViewMixin, APIView):
 
     def no_trend(self):
         try:
-            return [calculator.step(
+            return [cached_stage(
+                calculator.step,
                 data=self.pandas_timeseries,
                 bp=0,
                 alpha=float(self.request.session[
@@ -930,11 +969,14 @@ class BaseApiView(BaseViewMixin, APIView):
             return self.no_trend()
         elif 'Both' in selected_trend_type:
             return self.both_trends()
+        elif 'Mann-Kendall' in selected_trend_type:
+            return self.mann_kendall_trend()
         raise ValueError('Trend type unknown: ' + str(selected_trend_type))
 
     @cached_property
     def harmonic(self):
-        return calculator.harmonic(
+        return cached_stage(
+            calculator.harmonic,
             data=self.selected_trend[-1][0],
             n_harmonics=int(self.request.session['periodic_fluctuations'][
                 'spinner_0']['value'])
@@ -942,7 +984,18 @@ class BaseApiView(BaseViewMixin, APIView):
 
     @cached_property
     def correllogram(self):
-        return calculator.correlogram(
+        return cached_stage(
+            calculator.correlogram,
+            data=self.selected_trend[-1][0],
+            n_lags=int(self.request.session['autoregressive'][
+                'spinner_0']['value']),
+            windowed=True
+        )
+
+    @cached_property
+    def autocorrelation(self):
+        return cached_stage(
+            calculator.autocorrelation,
             data=self.selected_trend[-1][0],
             n_lags=int(self.request.session['autoregressive'][
                 'spinner_0']['value'])
@@ -950,12 +1003,23 @@ class BaseApiView(BaseViewMixin, APIView):
 
     @cached_property
     def autoregressive(self):
-        return calculator.autoregressive(
+        return cached_stage(
+            calculator.autoregressive,
             data=self.harmonic[0],
             per=int(self.request.session['autoregressive'][
                 'spinner_1']['value'])
         )
 
+    @cached_property
+    def autoregressive_orders(self):
+        data = self.harmonic[0]
+        per = int(self.request.session['autoregressive']['spinner_1']['value'])
+        return cached_stage(
+            calculator.autoregressive_orders,
+            data=data,
+            max_order=max(per, min(AR_MAX_ORDER, int(0.3 * len(data))))
+        )
+
     @property
     def button(self):
         return self.request.GET.get('button', '')
@@ -1048,9 +1112,13 @@ class MapDataView(BaseApiView):
         datatypes = request.GET.get('datatypes', 'locations,timeseries_').split(
             ',')
         try:
+            # the requests of all datatypes are made at the same time
+            results = async_connector.run(
+                *(getattr(self, x)() for x in datatypes))
             response_dict = {
                 "result": {
-                    x.strip('_'): getattr(self, x) for x in datatypes},
+                    x.strip('_'): result for x, result in
+                    zip(datatypes, results)},
                 "error": ""
             }
         except LizardApiError:
@@ -1063,31 +1131,29 @@ class MapDataView(BaseApiView):
             response_dict.update(self.base_response)
         return RestResponse(response_dict)
 
-    @property
-    def locations(self):
-        locations = GroundwaterLocations(use_header=self.logged_in)
+    async def locations(self):
+        locations = AsyncGroundwaterLocations(use_header=self.logged_in)
         south_west, north_east = self.coordinates
-        locations.bbox(south_west=south_west,
-                       north_east=north_east,
-                       organisation=self.selected_organisation_id)
+        await locations.bbox(south_west=south_west,
+                             north_east=north_east,
+                             organisation=self.selected_organisation_id)
         return locations.coord_uuid_name()
 
-    @property
-    def timeseries_(self):
+    async def timeseries_(self):
         gw_type, statistic = [
             x.strip(' ') for x in self.request.session['map_'].get(
                 'dropdown_0', {'value': 'GWmBGS | mean'})['value'].split('|')
         ]
-        timeseries = GroundwaterTimeSeries(use_header=self.logged_in)
+        timeseries = AsyncGroundwaterTimeSeries(use_header=self.logged_in)
         timeseries.queries = {
             "name": gw_type
         }
         south_west, north_east = self.coordinates
-        timeseries.bbox(south_west=south_west,
-                        north_east=north_east,
-                        organisation=self.selected_organisation_id,
-                        statistic=statistic,
-                        **self.time_window)
+        await timeseries.bbox(south_west=south_west,
+                              north_east=north_east,
+                              organisation=self.selected_organisation_id,
+                              statistic=statistic,
+                              **self.time_window)
         result = timeseries.ts_to_dict(
             start_date=jsdt.datestring_to_js(self.request.session['map_'][
                                                  'datepicker']['start']),
@@ -1143,6 +1209,8 @@ class TrendDataView(BaseApiView):
             ),
         ])
         self.statistics = [self.selected_trend[0][3]]
+        if self.breakpoint_suggestion:
+            self.statistics[0] += '\n' + self.breakpoint_suggestion
         try:
             result.append([
                 self.series_to_js(
@@ -1168,6 +1236,22 @@ class TrendDataView(BaseApiView):
             pass
         return result
 
+    @cached_property
+    def uses_step_trend(self):
+        selected_trend_type = self.request.session['trend_detection'][
+            'dropdown_0']['value']
+        return 'Step' in selected_trend_type or 'Both' in selected_trend_type
+
+    @cached_property
+    def breakpoint_suggestion(self):
+        if not self.uses_step_trend:
+            return ''
+        bp, _, pvals = self.breakpoint_scan
+        if bp == 0:
+            return ''
+        return 'Suggested breaking point: {0:%Y-%m-%d} (p-value = {1:.3g})' \
+            .format(self.pandas_timeseries.index[bp], pvals[bp])
+
 
 class FluctuationsDataView(BaseApiView):
     active = 'periodic_fluctuations'
@@ -1207,17 +1291,41 @@ class RegressiveDataView(BaseApiView):
 
     @cached_property
     def additional_response(self):
+        aic = self.autoregressive_orders[2]
         self.statistics = ["Akaike Information Criterion of the autoregressive "
                            "model is {:.2f}. Standard deviation of the "
-                           "innovation (error) term is {:.2f}".format(
-            self.autoregressive[3], self.autoregressive[4])]
+                           "innovation (error) term is {:.2f}. The order with "
+                           "the lowest AIC (up to {}) is {}".format(
+            self.autoregressive[3], self.autoregressive[4], len(aic) - 1,
+            int(np.argmin(aic)))]
         return [[
             self.series_to_js(
                 npseries=self.correllogram,
                 index=[],
                 key='Correlogram',
                 dates=False
-            )
+            ),
+            self.series_to_js(
+                npseries=self.autocorrelation[1],
+                index=[],
+                key='Partial correlogram',
+                dates=False,
+                color='#f39c12'
+            ),
+            self.series_to_js(
+                npseries=self.autocorrelation[2],
+                index=[],
+                key='95% confidence limit',
+                dates=False,
+                color='#95a5a6'
+            ),
+            self.series_to_js(
+                npseries=-self.autocorrelation[2],
+                index=[],
+                key='95% confidence limit (lower)',
+                dates=False,
+                color='#95a5a6'
+            ),
         ], [
             self.series_to_js(
                 npseries=self.harmonic[0],
@@ -1238,6 +1346,17 @@ class RegressiveDataView(BaseApiView):
             ),
         ]]
 
+    @property
+    def base_response(self):
+        response = super().base_response
+        # AIC of every order of the autoregressive model
+        aic = self.autoregressive_orders[2]
+        response['orders'] = {
+            'suggested': int(np.argmin(aic)),
+            'aic': ChartValues(np.arange(len(aic)), aic),
+        }
+        return response
+
 
 class AdditiveDataView(BaseApiView):
     active = 'additive'
@@ -1273,79 +1392,51 @@ class DownloadAllView(BaseView):
     template_name = 'freq/no_download.html'
 
     def get(self, request, *args, **kwargs):
-        # we need the referer to reload the page with the task url set.
+        # we need the referer to reload the page with the download status.
         referer = request.META.get('HTTP_REFERER')
-        if not self.downloading:
-            # start the task
+        job = self.download_job
+        if job is None or job['status'] == download_jobs.FAILURE:
+            # start the download in the background
             logger.debug('Downloading csv for %s', self.selected_organisation)
-            ts = GroundwaterTimeSeries(use_header=self.logged_in)
-            task_url, extra_queries = ts.start_csv_task(
-                organisation=self.selected_organisation_id)
-            download_organisations = self.request.session.get(
-                'download', {}).get('organisations', {})
+            download_jobs.download_jobs().start(
+                self.selected_organisation_id, use_header=self.logged_in)
             self.set_session_value('download', 'error_message',
                                    'Starting download.')
-            download_organisations.update({
-                self.selected_organisation_id: {
-                    'url': task_url,
-                    'extra_queries': extra_queries,
-                    'downloading': True
-                }
-            })
-            print(download_organisations)
-            self.request.session[
-                'download']['organisations'] = download_organisations
-            self.request.session.modified = True
-            # task is start and set, return with the current (referred) view.
+            # download is started, return with the current (referred) view.
             return redirect(referer)
-        # download was started earlier
-        try:
-            # try to download the result
-            extra_queries = self.request.session['download']['organisations'][
-                self.selected_organisation_id]['extra_queries']
-            header, csv_ = self.task.timeseries_csv(
-                organisation=self.selected_organisation_id,
-                extra_queries_ts=extra_queries
-            )
-        except LizardApiError:
-            # the download failed, which means the download is not yet ready.
+        if job['status'] != download_jobs.SUCCESS:
+            # the download is not yet ready.
             if referer:
-                logger.debug('download failed, referer:', referer)
+                logger.debug('download not ready, referer: %s', referer)
                 self.set_session_value('download', 'error_message',
                                        'Your download is not ready.')
-                # we either
                 return redirect(referer)
-            # when a download is called without a referer and the task is not
+            # when a download is called without a referer and the job is not
             # yet finished return the placeholder view that states the download
             # is not yet finished:
             return super().get(request, *args, **kwargs)
 
-        # The task is finished create a csv response from the timseries_csv.
-        response = HttpResponse(content_type='text/csv')
+        # The job is finished, the export is served from disk as csv or with
+        # ?format=parquet or ?format=arrow as zipped tables.
+        file_format = request.GET.get('format', 'csv')
+        path = download_jobs.download_jobs().export_path(job, file_format)
+        if path is None:
+            logger.warning('No %s export, serving csv instead', file_format)
+            file_format = 'csv'
+            path = download_jobs.download_jobs().export_path(job)
         filename = slugify(self.selected_organisation)[:80] + \
-                   "_ggmn_timeseries.csv"
+                   "_ggmn_timeseries"
+        if file_format == 'csv':
+            filename += ".csv"
+            content_type = 'text/csv'
+        else:
+            filename += "_" + file_format + ".zip"
+            content_type = 'application/zip'
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
         response['Content-Disposition'] = 'attachment; filename="' + \
                                           filename + '"'
-
-        writer = csv.writer(response)
-        writer.writerow(['uuid', 'name', 'location_name', 'x', 'y'])
-        for row in header:
-            writer.writerow(row)
-        writer.writerow([])
-        writer.writerow(['name', 'uuid', 'timestamp', 'value'])
-        for row in csv_:
-            writer.writerow(row)
-
-        logger.debug('Wrote all data to csv-response, '
-                     'filename of output csv is: %s', filename)
-
-        # cleanup the session, so the download can start again later.
-        self.set_session_value('download', 'downloading', False)
-        download_organisations = self.request.session.get(
-            'download', {}).get('organisations', {})
-        del download_organisations[self.selected_organisation_id]
-        self.set_session_value(
-            'download', 'organisations', download_organisations)
+        logger.debug('Serving all data as %s-response, '
+                     'filename of output is: %s', file_format, filename)
         return response
 
 
@@ -1391,6 +1482,9 @@ class RestartMixin(object):
         bounds = request.session['map_']['bounds']
         org_name = request.GET.get('name', False)
         org_uuid = request.GET.get('uuid', False)
+        if self.logged_in:
+            # the organisations are looked up again after a restart
+            invalidate_organisations(self.user.get_username())
         if org_name and org_uuid:
             self.instantiate_session(preserve_download=True)
             request.session['map_']['bounds'] = bounds
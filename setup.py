@@ -18,13 +18,14 @@ install_requires = [
     'pandas',
     'pytz',
     'scipy',
-    'statsmodels',
     ],
 
 tests_require = [
     'nose',
     'coverage',
     'mock',
+    # reference implementations in the tests and benchmarks
+    'statsmodels',
     ]
 
 setup(name='freq',
@@ -45,7 +46,7 @@ setup(name='freq',
       zip_safe=False,
       install_requires=install_requires,
       tests_require=tests_require,
-      extras_require={'test': tests_require},
+      extras_require={'test': tests_require, 'export': ['pyarrow']},
       entry_points={
           'console_scripts': [
           ]},